@@ -1,11 +1,14 @@
-import os
+import os, re, time, threading, queue, itertools, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
 
 try:
     import pygame
 except ImportError: pass
 
 class Audio(object):
-    def preload_files(self, files):
+    def preload_files(self, files, workers=None, progress=None):
         raise NotImplementedError()
     def stop(self):
         raise NotImplementedError()
@@ -15,6 +18,12 @@ class Audio(object):
         raise NotImplementedError()
     def is_playing(self):
         raise NotImplementedError()
+    def prefetch_speech(self, texts):
+        pass
+    def prefetch_sounds(self, files):
+        pass
+    def get_speech_stats(self):
+        return {}
         
         
 class SpeakService(object):
@@ -22,66 +31,423 @@ class SpeakService(object):
         raise NotImplementedError()
     def stop(self):
         raise NotImplementedError()
+    def prefetch(self, texts):
+        pass
+    def get_stats(self):
+        return {}
         
         
-class PyTTSx3Service(SpeakService):
-    def __init__(self):
-        import pyttsx3, threading
+class Synthesizer(object):
+    #turns text into an audio file at path, language and voice keep the cache entries of different engines apart
+    language = ''
+    voice = ''
+    suffix = '.mp3'
+    max_workers = None #engines that are not thread safe set this to 1
+    def synthesize(self, text, path):
+        raise NotImplementedError()
+        
+        
+class GTTSSynthesizer(Synthesizer):
+    def __init__(self, lang='en'):
+        from gtts import gTTS
+        self.gTTS = gTTS
+        self.lang = lang
+        self.language = lang
+        self.voice = 'gtts'
+    def synthesize(self, text, path):
+        self.gTTS(text, lang=self.lang).save(path)
+        
+        
+class PyTTSx3Synthesizer(Synthesizer):
+    #offline engine, renders to wav files
+    suffix = '.wav'
+    max_workers = 1
+    def __init__(self, voice=None, language='en'):
+        import pyttsx3
         self.engine = pyttsx3.init()
-        t = threading.Thread(target=self.engine.startLoop)
-        t.setDaemon(True)
-        t.start()
+        if voice is not None:
+            self.engine.setProperty('voice', voice)
+        self.language = language
+        self.voice = 'pyttsx3-' + str(self.engine.getProperty('voice'))
+        self._lock = threading.Lock()
+    def synthesize(self, text, path):
+        with self._lock:
+            self.engine.save_to_file(text, path)
+            self.engine.runAndWait()
+        
+        
+def speech_cache(synthesizer, cache_dir='tts_cache', cache_bytes=None):
+    #one cache directory per voice, the file type differs between engines
+    #without cache_bytes the budget stored in the cache is used, e.g. the one set by a prerender
+    from cache import DiskCache
+    voice_dir = os.path.join(cache_dir, re.sub(r'[^\w.-]', '_', synthesizer.voice) or 'default')
+    if not os.path.isdir(voice_dir):
+        remove_legacy_speech(cache_dir)
+    return DiskCache(voice_dir, cache_bytes, suffix=synthesizer.suffix)
+    
+    
+def remove_legacy_speech(cache_dir):
+    #files of the old store were named by a truncated hash, their texts can not be recovered to index them
+    if not os.path.isdir(cache_dir):
+        return
+    for f in os.listdir(cache_dir):
+        if re.match(r'\d{8}\.mp3$', f):
+            try:
+                os.remove(os.path.join(cache_dir, f))
+            except OSError:
+                pass
+    
+    
+def prerender(texts, synthesizer, cache, workers=4, progress=None):
+    #synthesizes every text that is not cached yet, an interrupted run continues where it stopped
+    #stops with a ValueError instead of evicting texts it rendered itself when the budget is too small
+    texts = list(dict.fromkeys(texts))
+    keys = {text: cache.key(synthesizer.language, synthesizer.voice, text) for text in texts}
+    missing = [text for text in texts if keys[text] not in cache]
+    cached = len(texts) - len(missing)
+    def too_small(rendered):
+        stats = cache.stats()
+        average = stats['size'] / float(max(1, stats['entries']))
+        needed = stats['size'] + average * (len(missing) - rendered)
+        return ValueError('Speech cache budget of %.1f MB is too small, %d texts need about %.1f MB' % (
+            cache.max_bytes/2.**20, len(texts), needed/2.**20))
+    if cached and missing and cache.size + cache.size / float(cached) * len(missing) > cache.max_bytes:
+        raise too_small(0)
+    if synthesizer.max_workers is not None:
+        workers = min(workers, synthesizer.max_workers)
+    def render(text):
+        cache.put(keys[text], lambda path: synthesizer.synthesize(text, path))
+        return text
+    evictions = cache.evictions
+    rendered = failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(render, text) for text in missing]
+        for done, future in enumerate(futures, 1):
+            try:
+                future.result()
+                rendered += 1
+            except Exception as e:
+                print('Could not synthesize: %s' % e)
+                failed += 1
+            if cache.evictions != evictions:
+                for pending in futures:
+                    pending.cancel()
+                raise too_small(rendered)
+            if progress is not None:
+                progress(done, len(missing))
+    return {'texts': len(texts), 'cached': cached, 'rendered': rendered, 'failed': failed,
+            'evicted': cache.evictions - evictions}
+        
+        
+def split_sentences(text, max_chars=120):
+    #short chunks get the first words out quickly, long sentences are split at commas
+    text = ' '.join(text.split())
+    chunks = []
+    for sentence in re.split(r'(?<=[.!?])\s+', text):
+        while len(sentence) > max_chars and ', ' in sentence[:max_chars]:
+            cut = sentence.rindex(', ', 0, max_chars) + 1
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if sentence:
+            chunks.append(sentence)
+    return chunks
+    
+    
+class PyTTSx3Service(SpeakService):
+    #the engine is only touched by its own thread, speak() and stop() post commands to it
+    #and only the newest utterance is kept
+    def __init__(self, max_chunk=120, init_timeout=10.):
+        import pyttsx3
+        self.max_chunk = max_chunk
+        self._commands = queue.Queue()
+        self._first_chunk = None
+        self._requested = 0.
+        self.start_latency = None
+        self.stop_latency = None
+        self.spoken = 0
+        self.dropped = 0
+        #the engine has to be created on the thread that drives it, the constructor waits to see it come up
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(pyttsx3,))
+        self._thread.daemon = True
+        self._thread.start()
+        if not self._ready.wait(init_timeout):
+            raise RuntimeError('pyttsx3 engine did not start within %.0fs' % init_timeout)
+        if self._error is not None:
+            raise self._error
+        
+    def _run(self, pyttsx3):
+        try:
+            engine = pyttsx3.init()
+            engine.connect('started-utterance', self._on_started)
+            engine.startLoop(False)
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            self._loop(engine)
+        except Exception as e:
+            #speak() stops queueing once the engine is gone
+            self._error = e
+            traceback.print_exc()
+            
+    def _loop(self, engine):
+        generation = 0
+        while True:
+            try:
+                commands = [self._commands.get(timeout=.005 if engine.isBusy() else None)]
+            except queue.Empty:
+                commands = []
+            while True:
+                try:
+                    commands.append(self._commands.get_nowait())
+                except queue.Empty:
+                    break
+            if commands:
+                kind, text, requested = commands[-1]
+                self.dropped += sum(1 for command in commands if command[0] == 'speak') - (kind == 'speak')
+                if engine.isBusy():
+                    engine.stop()
+                    deadline = time.perf_counter() + .5
+                    while engine.isBusy() and time.perf_counter() < deadline:
+                        engine.iterate()
+                    self.stop_latency = time.perf_counter() - requested
+                if kind == 'speak':
+                    generation += 1
+                    self._first_chunk = '%d:0' % generation
+                    self._requested = requested
+                    for i, chunk in enumerate(split_sentences(text, self.max_chunk)):
+                        engine.say(chunk, '%d:%d' % (generation, i))
+            engine.iterate()
+            
+    def _on_started(self, name):
+        if name == self._first_chunk:
+            self.start_latency = time.perf_counter() - self._requested
+            self.spoken += 1
+            
     def speak(self, text):
-        self.engine.say(text)
+        self._post('speak', text)
     def stop(self):
-        self.engine.stop()
+        self._post('stop', None)
+    def _post(self, kind, text):
+        if self._thread.is_alive():
+            self._commands.put((kind, text, time.perf_counter()))
+        
+    def get_stats(self):
+        def ms(seconds):
+            return None if seconds is None else seconds*1000.
+        return {'start_ms': ms(self.start_latency), 'stop_ms': ms(self.stop_latency), 
+                'spoken': self.spoken, 'dropped': self.dropped}
         
 class GoogleTTSService(SpeakService):
-    def __init__(self):
-        import hashlib, os, re
-        from gtts import gTTS
-        def h(s):
-            return int(hashlib.sha256(s.encode("utf-8")).hexdigest(), 16) % 10**8
-        self.gTTS = gTTS
-        self.hash_func = h
-        self.hash_files = {}
-        files = os.listdir("tts_cache")
-        regex = re.compile("(\d{8}).mp3")
-        for f in files:
-            m = regex.match(f)
-            if m is not None:
-                self.hash_files[int(m.group(1))] = 0
+    #synthesis runs on a worker thread, speak() plays what is ready and otherwise plays it once it is
+    SPEAK, PREFETCH = 0, 1
+    
+    def __init__(self, synthesizer=None, cache_dir='tts_cache', cache_bytes=None, retry_delay=30., max_retry_delay=3600.):
+        self.synthesizer = synthesizer if synthesizer is not None else GTTSSynthesizer()
+        self.cache = speech_cache(self.synthesizer, cache_dir, cache_bytes)
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._loading = {} #text -> best priority it is queued with
+        self._failed = {} #text -> (time it may be tried again, delay after the next failure)
+        self._wanted = None #text to play as soon as it is synthesized
+        self._lock = threading.Lock()
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        t.start()
+        
+    def _key_of(self, text):
+        return self.cache.key(self.synthesizer.language, self.synthesizer.voice, text)
         
+    def _is_ready(self, text):
+        return self._key_of(text) in self.cache
+        
+    def _backing_off(self, text):
+        return text in self._failed and time.time() < self._failed[text][0]
+        
+    def _request(self, text, priority):
+        with self._lock:
+            if self._is_ready(text) or self._loading.get(text, priority+1) <= priority or self._backing_off(text):
+                return
+            self._loading[text] = priority
+        #a text queued again with a higher priority is just queued twice, the worker skips the stale entry
+        #within a priority the newest request goes first, older prefetches are for entries already left
+        self._queue.put((priority, -next(self._order), text))
+        
+    def _work(self):
+        while True:
+            priority, order, text = self._queue.get()
+            if self._is_ready(text):
+                continue
+            try:
+                print('New TTS file!')
+                path = self.cache.put(self._key_of(text), lambda path: self.synthesizer.synthesize(text, path))
+            except Exception:
+                #a failing text is not requested again until its delay is over, the delay doubles with every failure
+                with self._lock:
+                    if text not in self._failed:
+                        traceback.print_exc()
+                    retry_at, delay = self._failed.get(text, (0., self.retry_delay))
+                    self._failed[text] = (time.time() + delay, min(delay*2, self.max_retry_delay))
+                    self._loading.pop(text, None)
+                    if self._wanted == text:
+                        self._wanted = None
+                continue
+            with self._lock:
+                self._loading.pop(text, None)
+                self._failed.pop(text, None)
+                if self._wanted == text:
+                    self._wanted = None
+                    if not self._play(path):
+                        self.cache.discard(self._key_of(text))
+        
+    def _play(self, path):
+        #False if the file could not be played, e.g. it is truncated
+        try:
+            pygame.mixer.music.load(path)
+            pygame.mixer.music.play()
+        except pygame.error as e:
+            print('Could not play %s: %s' % (path, e))
+            return False
+        return True
+        
+    def prefetch(self, texts):
+        for text in reversed(texts):
+            self._request(text, self.PREFETCH)
         
     def speak(self, text):
-        hash_ = self.hash_func(text)
-        hash_file = "tts_cache/"+str(hash_)+".mp3"
-        if hash_ not in self.hash_files:
-            print('New TTS file!')
-            tts = self.gTTS(text, lang='en')
-            tts.save(hash_file)
-            self.hash_files[hash_] = 0
-        pygame.mixer.music.load(hash_file)
-        pygame.mixer.music.play()
+        with self._lock:
+            path = self.cache.get(self._key_of(text))
+            if path is not None:
+                self._wanted = None
+                if self._play(path):
+                    return
+                self.cache.discard(self._key_of(text))
+            self._wanted = text if not self._backing_off(text) else None
+        self._request(text, self.SPEAK)
         
     def stop(self):
+        with self._lock:
+            self._wanted = None
         pygame.mixer.music.stop()
         
         
         
 class PygameAudio(Audio):
     
-    def __init__(self):
+    def __init__(self, sound_cache_bytes=32*1024*1024, pcm_dir=None, pcm_bytes=None, prefetch_workers=1, 
+                 speak_service=None):
         pygame.mixer.init(frequency=32728)
-        self._audio_cache = {}
-        self.speak_service = GoogleTTSService()
+        self.mixer_format = pygame.mixer.get_init()
+        self._audio_cache = {} #preloaded sounds, kept for good
+        self._sound_cache = LRUCache(sound_cache_bytes, size_of=self._sound_bytes)
+        self._missing = set()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=prefetch_workers) if prefetch_workers else None
+        #optional store of decoded cries, bounded like the speech cache
+        self.pcm_store = None
+        if pcm_dir is not None:
+            from cache import DiskCache
+            self.pcm_store = DiskCache(pcm_dir, pcm_bytes, suffix='.pcm')
+        self.speak_service = speak_service if speak_service is not None else GoogleTTSService()
         
-    def preload_files(self, files):
-        for filepath in files:
+    def _sound_bytes(self, sound):
+        frequency, size, channels = self.mixer_format
+        return int(sound.get_length() * frequency) * channels * (abs(size)//8)
+        
+    def _pcm_key(self, filepath):
+        #raw samples in the mixer format, so loading them needs no decode or resample
+        #the source mtime is part of the key, entries of replaced cries age out of the store
+        return self.pcm_store.key(os.path.abspath(filepath), str(os.stat(filepath).st_mtime_ns), 
+                                  *[str(value) for value in self.mixer_format])
+        
+    def _decode_sound(self, filepath):
+        try:
+            key = self._pcm_key(filepath) if self.pcm_store is not None else None
+        except OSError:
+            return None
+        if key is not None:
+            pcm_file = self.pcm_store.get(key)
+            if pcm_file is not None:
+                try:
+                    with open(pcm_file, 'rb') as f:
+                        return pygame.mixer.Sound(buffer=f.read())
+                except OSError:
+                    self.pcm_store.discard(key)
+        try:
+            sound = pygame.mixer.Sound(filepath)
+        except (pygame.error, OSError):
+            return None
+        if key is not None:
+            def write(path):
+                with open(path, 'wb') as f:
+                    f.write(sound.get_raw())
+            try:
+                self.pcm_store.put(key, write)
+            except OSError as e:
+                print('Could not store decoded cry: %s' % e)
+        return sound
+        
+    def _load_sound(self, filepath):
+        try:
+            sound = self._decode_sound(filepath)
+            if sound is None:
+                self._missing.add(filepath)
+            else:
+                self._sound_cache.put(filepath, sound)
+            return sound
+        finally:
+            with self._lock:
+                self._loading.pop(filepath, None)
+        
+    def preload_files(self, files, workers=None, progress=None):
+        if workers:
+            from preload import ParallelPreloader
+            preloader = ParallelPreloader(workers, pygame.mixer.get_init())
+            self._audio_cache.update(preloader.load_sounds(files, progress=progress))
+            return
+        for done, filepath in enumerate(files, 1):
+            if progress is not None:
+                progress(done, len(files))
             if not os.path.isfile(filepath):
                 continue
             data = pygame.mixer.Sound(filepath)
             self._audio_cache[filepath] = data
+            
+    def prefetch_sounds(self, files):
+        if self._pool is None:
+            return
+        for filepath in files:
+            if filepath in self._audio_cache or filepath in self._sound_cache or filepath in self._missing:
+                continue
+            with self._lock:
+                if filepath not in self._loading:
+                    self._loading[filepath] = self._pool.submit(self._load_sound, filepath)
+                    
+    def load_sound(self, filepath):
+        sound = self._audio_cache.get(filepath)
+        if sound is not None:
+            return sound
+        sound = self._sound_cache.get(filepath)
+        if sound is not None or filepath in self._missing:
+            return sound
+        with self._lock:
+            loading = self._loading.get(filepath)
+        if loading is not None: #already being decoded by the prefetcher
+            return loading.result()
+        return self._load_sound(filepath)
+        
+    def get_cache_stats(self):
+        stats = {'sound': self._sound_cache.stats()}
+        if self.pcm_store is not None:
+            stats['pcm'] = self.pcm_store.stats()
+        return stats
         
     def stop(self):
         pygame.mixer.stop()
@@ -89,15 +455,17 @@ class PygameAudio(Audio):
     
     def speak(self, text):
         self.speak_service.speak(text)
+        
+    def prefetch_speech(self, texts):
+        self.speak_service.prefetch(texts)
+        
+    def get_speech_stats(self):
+        return self.speak_service.get_stats()
     
     def play_wav(self, filepath):
-        if not os.path.isfile(filepath):
-            return
-        if filepath in self._audio_cache:
-            data = self._audio_cache[filepath]
-        else:
-            data = pygame.mixer.Sound(filepath)
-        data.play()
+        data = self.load_sound(filepath)
+        if data is not None:
+            data.play()
         
     def is_playing(self):
         return pygame.mixer.get_busy()
\ No newline at end of file
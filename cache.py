@@ -0,0 +1,175 @@
+import os, time, threading, hashlib, sqlite3
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    #bounded by entry count, or by bytes when size_of is given
+    def __init__(self, max_size, size_of=None):
+        self.max_size = max_size
+        self.size_of = size_of if size_of is not None else (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key][0]
+            self.misses += 1
+            return default
+            
+    def put(self, key, value):
+        size = self.size_of(value)
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size and len(self._items) > 1:
+                old_value, old_size = self._items.popitem(last=False)[1]
+                self.size -= old_size
+                self.evictions += 1
+        return value
+        
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+            
+    def stats(self):
+        return {'entries': len(self._items), 'size': self.size, 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+            
+    def __contains__(self, key):
+        return key in self._items
+        
+    def __len__(self):
+        return len(self._items)
+        
+        
+class DiskCache(object):
+    #files named by the full sha256 of their key, with a sqlite index of sizes and last use for LRU eviction by bytes
+    #the byte budget is stored in the index, so every user of the directory shares the one that was set last
+    DEFAULT_MAX_BYTES = 64*1024*1024
+    
+    def __init__(self, directory, max_bytes=None, suffix='', index_name='index.sqlite'):
+        self.directory = directory
+        self.suffix = suffix
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, index_name), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value INTEGER)')
+        if max_bytes is not None:
+            self.conn.execute('INSERT OR REPLACE INTO settings VALUES (?,?)', ('max_bytes', int(max_bytes)))
+        self.conn.commit()
+        row = self.conn.execute('SELECT value FROM settings WHERE name=?', ('max_bytes',)).fetchone()
+        self.max_bytes = row[0] if row is not None else self.DEFAULT_MAX_BYTES
+        self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        self.evictions = 0
+        self._remove_partial()
+        
+    def _remove_partial(self):
+        #files a crashed or killed put() left behind, they were never indexed
+        for f in os.listdir(self.directory):
+            if '.part' in f:
+                try:
+                    os.remove(os.path.join(self.directory, f))
+                except OSError:
+                    pass
+        
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+        
+    def path_of(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+        
+    def __contains__(self, key):
+        with self._lock:
+            if self.conn.execute('SELECT 1 FROM entries WHERE key=?', (key,)).fetchone() is None:
+                return False
+            return self._check_file(key)
+        
+    def get(self, key):
+        #path of the cached file, None if it is not cached
+        with self._lock:
+            cursor = self.conn.execute('UPDATE entries SET used=? WHERE key=?', (time.time(), key))
+            self.conn.commit()
+            if not cursor.rowcount or not self._check_file(key):
+                return None
+        return self.path_of(key)
+        
+    def _check_file(self, key):
+        #an indexed file that was deleted behind the cache's back is dropped from the index
+        if os.path.isfile(self.path_of(key)):
+            return True
+        self._drop(key)
+        return False
+        
+    def _drop(self, key):
+        row = self.conn.execute('SELECT size FROM entries WHERE key=?', (key,)).fetchone()
+        if row is not None:
+            self.conn.execute('DELETE FROM entries WHERE key=?', (key,))
+            self.conn.commit()
+            self.size -= row[0]
+            
+    def discard(self, key):
+        #for files that turned out to be unreadable
+        with self._lock:
+            self._drop(key)
+        try:
+            os.remove(self.path_of(key))
+        except OSError:
+            pass
+        
+    def put(self, key, write):
+        #write(path) creates the file, it is only indexed once it is completely on disk
+        path = self.path_of(key)
+        tmp_path = os.path.join(self.directory, key + '.part' + self.suffix)
+        try:
+            write(tmp_path)
+            with open(tmp_path, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        size = os.path.getsize(path)
+        with self._lock:
+            row = self.conn.execute('SELECT size FROM entries WHERE key=?', (key,)).fetchone()
+            self.size += size - (row[0] if row is not None else 0)
+            self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?)', (key, size, time.time()))
+            self._evict(key)
+            self.conn.commit()
+        return path
+        
+    def _evict(self, keep):
+        while self.size > self.max_bytes:
+            row = self.conn.execute('SELECT key, size FROM entries WHERE key!=? ORDER BY used LIMIT 1', (keep,)).fetchone()
+            if row is None:
+                break
+            self.conn.execute('DELETE FROM entries WHERE key=?', (row[0],))
+            self.size -= row[1]
+            self.evictions += 1
+            try:
+                os.remove(self.path_of(row[0]))
+            except OSError:
+                pass
+            
+    def stats(self):
+        with self._lock:
+            entries = self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return {'entries': entries, 'size': self.size, 'max_size': self.max_bytes, 'evictions': self.evictions}
+        
+    def close(self):
+        self.conn.close()
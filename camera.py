@@ -1,18 +1,218 @@
-
+import time, threading
 import cv2
 import numpy as np
 
 class Camera(object):
-    def get_img(self):
+    def __init__(self):
+        self._scaled = None
+        self._preview = None
+
+    def read(self, out=None):
+        #raw BGR frame in row-major (h,w,3) layout, written into out when given
         raise NotImplementedError()
-        
+
+    def get_img(self, size=None):
+        frame = self.read()
+        if frame is None:
+            return None
+        return self.to_preview(frame, size)
+
+    def start(self):
+        pass
+
+    def pause(self):
+        pass
+
+    def get_latest(self):
+        #(capture time, frame), cameras without a capture thread grab a new frame
+        frame = self.read()
+        return (time.time(), frame) if frame is not None else (None, None)
+
+    def to_preview(self, frame, size=None):
+        #same orientation as np.rot90(rgb_frame, 3): preview[x][y] is frame[h-1-y][x]
+        h,w = frame.shape[:2]
+        if size is not None and (size[0],size[1]) != (w,h):
+            if self._scaled is None or self._scaled.shape[:2] != (size[1],size[0]):
+                self._scaled = np.empty((size[1],size[0],3), np.uint8)
+            frame = cv2.resize(frame, (size[0],size[1]), dst=self._scaled, interpolation=cv2.INTER_NEAREST)
+            h,w = size[1],size[0]
+        if self._preview is None or self._preview.shape[:2] != (h,w):
+            self._preview = np.empty((h,w,3), np.uint8)
+        #flip rows into the preallocated buffer and swap BGR to RGB in place, no temporary arrays
+        cv2.flip(frame, 0, dst=self._preview)
+        cv2.cvtColor(self._preview, cv2.COLOR_BGR2RGB, dst=self._preview)
+        return self._preview.transpose(1,0,2)
+
+
 class OpenCVCamera(Camera):
-    def __init__(self):
-        self.cap = cv2.VideoCapture(0)
+    OWN_BUFFER = object() #read() without out reuses one buffer of the camera, out=None asks for a new array
+
+    def __init__(self, source=0):
+        super().__init__()
+        self.cap = cv2.VideoCapture(source)
         self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1);
+        self._frame = None
+
+    def read(self, out=OWN_BUFFER):
+        own = out is self.OWN_BUFFER
+        ret,frame = self.cap.read(self._frame if own else out)
+        if not ret:
+            return None
+        if own:
+            self._frame = frame
+        return frame
+
+
+class ImageFileCamera(Camera):
+    #stand-in camera that cycles through image files
+    def __init__(self, files, fps=30.):
+        super().__init__()
+        self.frames = [cv2.imread(f, cv2.IMREAD_COLOR) for f in files]
+        self.frames = [frame for frame in self.frames if frame is not None]
+        self.interval = 1./fps if fps else 0.
+        self.index = 0
+
+    def read(self, out=None):
+        if not self.frames:
+            return None
+        if self.interval:
+            time.sleep(self.interval)
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        if out is not None and out.shape == frame.shape:
+            np.copyto(out, frame)
+            return out
+        return frame.copy()
+
+
+class SyntheticCamera(Camera):
+    #stand-in camera producing a moving test pattern
+    def __init__(self, size=(640,480), fps=30.):
+        super().__init__()
+        self.size = size
+        self.interval = 1./fps if fps else 0.
+        self.count = 0
+        x = np.arange(size[0], dtype=np.uint16)
+        y = np.arange(size[1], dtype=np.uint16)
+        self._pattern = (x[None,:] + y[:,None]).astype(np.uint8)
+
+    def read(self, out=None):
+        if self.interval:
+            time.sleep(self.interval)
+        if out is None or out.shape != (self.size[1],self.size[0],3):
+            out = np.empty((self.size[1],self.size[0],3), np.uint8)
+        np.add(self._pattern, np.uint8(self.count % 256), out=out[:,:,0])
+        out[:,:,1] = self._pattern
+        out[:,:,2] = np.uint8(self.count * 7 % 256)
+        self.count += 1
+        return out
+
+
+class ThreadedCamera(Camera):
+    #grabs frames from another camera on a thread into a small ring of preallocated buffers,
+    #only between start() and pause() so the camera costs nothing while no menu shows it
+    #frames handed out are ring buffers, not copies: one stays valid until ring_size-1 newer frames
+    #were captured (about 66ms with 3 slots at 30fps), copy it to keep it longer
+    def __init__(self, source, ring_size=3, max_age=0.5, autostart=False):
+        super().__init__()
+        self.source = source
+        self.ring_size = max(2, ring_size)
+        self.max_age = max_age
+        self._ring = [None] * self.ring_size
+        self._stamps = [None] * self.ring_size
+        self._latest = -1
+        self._lock = threading.Lock()
+        self._fps = 0.
+        self._running = False
+        self._thread = None
+        if autostart:
+            self.start()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._capture_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def pause(self):
+        if self._thread is None:
+            return
+        self._running = False
+        self._thread.join()
+        self._thread = None
+        with self._lock:
+            self._latest = -1
+            self._fps = 0.
+
+    def _capture_loop(self):
+        slot = 0
+        last_stamp = None
+        while self._running:
+            with self._lock:
+                #the slot being written is left out of get_since and get_latest until it is complete
+                self._stamps[slot] = None
+                if self._latest == slot:
+                    self._latest = -1
+            frame = self.source.read(self._ring[slot])
+            if frame is None:
+                time.sleep(0.01)
+                continue
+            if any(frame is other for i, other in enumerate(self._ring) if i != slot):
+                frame = frame.copy() #the source handed out a buffer another slot holds, every slot needs its own
+            stamp = time.time()
+            with self._lock:
+                self._ring[slot] = frame
+                self._stamps[slot] = stamp
+                self._latest = slot
+                if last_stamp is not None and stamp > last_stamp:
+                    fps = 1./(stamp-last_stamp)
+                    self._fps = fps if not self._fps else .9*self._fps + .1*fps
+            last_stamp = stamp
+            slot = (slot+1) % self.ring_size
+
+    def stop(self):
+        self.pause()
+
+    def read(self, out=None):
+        stamp,frame = self.get_latest()
+        if frame is None:
+            return None
+        if out is not None and out.shape == frame.shape:
+            np.copyto(out, frame)
+            return out
+        return frame.copy()
+
+    def get_latest(self):
+        #newest frame that is not older than max_age, without waiting for the sensor
+        with self._lock:
+            if self._latest < 0:
+                return None, None
+            stamp = self._stamps[self._latest]
+            if self.max_age is not None and time.time() - stamp > self.max_age:
+                return None, None
+            return stamp, self._ring[self._latest]
+
+    def get_since(self, timestamp):
+        #frames captured after timestamp, oldest first
+        with self._lock:
+            frames = [(stamp, frame) for stamp, frame in zip(self._stamps, self._ring)
+                      if stamp is not None and (timestamp is None or stamp > timestamp)]
+        frames.sort(key=lambda f: f[0])
+        return frames
+
+    def get_img(self, size=None):
+        stamp,frame = self.get_latest()
+        if frame is None:
+            return None
+        return self.to_preview(frame, size)
+
+    def frame_age(self):
+        with self._lock:
+            if self._latest < 0:
+                return None
+            return time.time() - self._stamps[self._latest]
 
-    def get_img(self):
-        ret,frame = self.cap.read()
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        frame = np.rot90(frame, 3)
-        return frame
\ No newline at end of file
+    def capture_fps(self):
+        return self._fps
@@ -1,3 +1,4 @@
+import time
 from enum import Enum
 
 try:
@@ -19,6 +20,9 @@ class Actions(Enum):
 class Controller(object):
     def get_actions(self):
         raise NotImplementedError()
+    def wait_actions(self, timeout):
+        time.sleep(timeout)
+        return self.get_actions()
         
 class DummyController(Controller):
     def get_actions(self):
@@ -35,10 +39,24 @@ class PygameController(Controller):
             pygame.K_DOWN : Actions.MENU_DOWN,
             pygame.K_RETURN : Actions.MENU_OK,
         }
+        #only events that become actions wake up wait_actions
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([pygame.KEYDOWN, pygame.QUIT, pygame.MOUSEBUTTONUP])
         
     def get_actions(self):
+        return self._to_actions(pygame.event.get())
+        
+    def wait_actions(self, timeout):
+        timeout = int(timeout*1000)
+        #a timeout of 0 would make pygame wait forever
+        event = pygame.event.wait(timeout) if timeout > 0 else pygame.event.poll()
+        if event.type == pygame.NOEVENT:
+            return []
+        return self._to_actions([event] + pygame.event.get())
+        
+    def _to_actions(self, events):
         actions = []
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.KEYDOWN and event.key in self.key_bindings:
                 actions.append(self.key_bindings[event.key])
                     
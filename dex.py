@@ -1,13 +1,287 @@
-import sqlite3, os
-import urllib, io, gzip, tarfile
+import sqlite3, os, sys
+import urllib.parse
+import mmap, struct, json
+import threading, queue
+from array import array
+from collections import OrderedDict
+from collections.abc import Sequence
+
+import download
+from search import DexSearchIndex
+
+
+class RangeView(Sequence):
+    __slots__ = ('_seq', '_start', '_stop')
+    
+    def __init__(self, seq, start, stop):
+        self._seq = seq
+        self._start = max(0, start)
+        self._stop = max(self._start, min(len(seq), stop))
+        
+    def __len__(self):
+        return self._stop - self._start
+        
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return self._seq[self._start+i]
+
+
+class DexInfo(object):
+    #columnar info table: names, interned type ids and one utf-8 blob for all flavor texts
+    __slots__ = ('names', 'type_names', 'type1', 'type2', 'text', 'text_offsets')
+    
+    def __init__(self, names, type_names, type1, type2, text, text_offsets):
+        self.names = names
+        self.type_names = type_names
+        self.type1 = type1
+        self.type2 = type2
+        self.text = text
+        self.text_offsets = text_offsets
+        
+    @classmethod
+    def from_rows(cls, rows):
+        names = []
+        type_names = [None] #type id 0 is 'no type'
+        type_ids = {None: 0}
+        type1 = array('H')
+        type2 = array('H')
+        text = bytearray()
+        text_offsets = array('I', [0])
+        for name, t1, t2, description in rows:
+            names.append(sys.intern(name))
+            for t, column in ((t1, type1), (t2, type2)):
+                if t not in type_ids:
+                    type_ids[t] = len(type_names)
+                    type_names.append(sys.intern(t))
+                column.append(type_ids[t])
+            text += description.encode('utf-8')
+            text_offsets.append(len(text))
+        return cls(names, type_names, type1, type2, bytes(text), text_offsets)
+        
+    def __len__(self):
+        return len(self.names)
+        
+    def get_name(self, index):
+        return self.names[index]
+    def get_description(self, index):
+        return str(self.text[self.text_offsets[index]:self.text_offsets[index+1]], 'utf-8')
+    def get_type1(self, index):
+        return self.type_names[self.type1[index]]
+    def get_type2(self, index):
+        return self.type_names[self.type2[index]]
+        
+    def names_in_range(self, index_from, index_to):
+        return RangeView(self.names, index_from, index_to)
+        
+    #snapshot file: header, then 4-byte aligned sections
+    #name offsets, names, type name offsets, type names, type1, type2, text offsets, text
+    MAGIC = b'PIDEXNFO'
+    HEADER = struct.Struct('=8sIqqII')
+    FORMAT_VERSION = 1
+    
+    @staticmethod
+    def _pack_strings(strings):
+        blob = bytearray()
+        offsets = array('I', [0])
+        for s in strings:
+            blob += (s or '').encode('utf-8')
+            offsets.append(len(blob))
+        return offsets, bytes(blob)
+        
+    def save(self, path, stamp):
+        name_offsets, names = self._pack_strings(self.names)
+        type_offsets, types = self._pack_strings(self.type_names)
+        sections = [name_offsets, names, type_offsets, types,
+                    self.type1, self.type2, self.text_offsets, self.text]
+        tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.FORMAT_VERSION, stamp[0], stamp[1], 
+                                     len(self.names), len(self.type_names)))
+            for section in sections:
+                data = memoryview(section).cast('B')
+                f.write(struct.pack('=I', len(data)))
+                f.write(data)
+                f.write(b'\0' * (-len(data) % 4))
+        os.replace(tmp_path, path)
+        
+    @classmethod
+    def load(cls, path, stamp):
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: #empty file
+                return None
+        if len(buf) < cls.HEADER.size:
+            return None
+        magic, version, mtime, size, count, type_count = cls.HEADER.unpack_from(buf, 0)
+        if magic != cls.MAGIC or version != cls.FORMAT_VERSION or (mtime, size) != tuple(stamp):
+            return None
+        view = memoryview(buf)
+        sections = []
+        pos = cls.HEADER.size
+        for i in range(8):
+            length, = struct.unpack_from('=I', buf, pos)
+            pos += 4
+            sections.append(view[pos:pos+length])
+            pos += length + (-length % 4)
+        name_offsets, names, type_offsets, types, type1, type2, text_offsets, text = sections
+        name_offsets = name_offsets.cast('I')
+        names = bytes(names)
+        names = [sys.intern(str(names[name_offsets[i]:name_offsets[i+1]], 'utf-8')) for i in range(count)]
+        type_offsets = type_offsets.cast('I')
+        types = bytes(types)
+        type_names = [None] + [sys.intern(str(types[type_offsets[i]:type_offsets[i+1]], 'utf-8')) 
+                               for i in range(1, type_count)]
+        return cls(names, type_names, type1.cast('H'), type2.cast('H'), text, text_offsets.cast('I'))
+        
+        
+class DexInfoEntry(object):
+    __slots__ = ('info', 'index')
+    
+    def __init__(self, info, index):
+        self.info = info
+        self.index = index
+        
+    @property
+    def name(self):
+        return self.info.get_name(self.index)
+    @property
+    def description(self):
+        return self.info.get_description(self.index)
+    @property
+    def type1(self):
+        return self.info.get_type1(self.index)
+    @property
+    def type2(self):
+        return self.info.get_type2(self.index)
     
 
+#tables and columns used by VeekunPokedex, keyed so that the primary key covers its joins
+COMPILED_TABLES = [
+    ('pokemon', 'id INTEGER PRIMARY KEY, species_id INTEGER NOT NULL', None),
+    ('pokemon_species_names', 'pokemon_species_id INTEGER, local_language_id INTEGER, name TEXT', 
+     'pokemon_species_id, local_language_id'),
+    ('pokemon_species_flavor_text', 'species_id INTEGER, language_id INTEGER, version_id INTEGER, flavor_text TEXT', 
+     'species_id, language_id, version_id'),
+    ('pokemon_types', 'pokemon_id INTEGER, slot INTEGER, type_id INTEGER', 'pokemon_id, slot'),
+    ('type_names', 'type_id INTEGER, local_language_id INTEGER, name TEXT', 'type_id, local_language_id'),
+    ('versions', 'id INTEGER PRIMARY KEY', None),
+    ('version_names', 'version_id INTEGER, local_language_id INTEGER, name TEXT', 'version_id, local_language_id'),
+    ('languages', 'id INTEGER PRIMARY KEY, iso639 TEXT, identifier TEXT', None),
+    ('language_names', 'language_id INTEGER, local_language_id INTEGER, name TEXT', 'language_id, local_language_id'),
+]
+
+def compile_db(src_file, dst_file):
+    if not os.path.isfile(src_file):
+        raise FileNotFoundError(src_file)
+    tmp_file = dst_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    conn = sqlite3.connect(tmp_file)
+    conn.execute('PRAGMA page_size=4096')
+    conn.execute('ATTACH DATABASE ? AS src', (src_file,))
+    for table, columns, key in COMPILED_TABLES:
+        names = ', '.join(col.split()[0] for col in columns.split(','))
+        if key is None:
+            conn.execute('CREATE TABLE %s (%s)' % (table, columns))
+        else:
+            conn.execute('CREATE TABLE %s (%s, PRIMARY KEY (%s)) WITHOUT ROWID' % (table, columns, key))
+        conn.execute('INSERT INTO main.%s (%s) SELECT %s FROM src.%s' % (table, names, names, table))
+    conn.commit()
+    conn.execute('DETACH DATABASE src')
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+    os.chmod(tmp_file, 0o444)
+    os.replace(tmp_file, dst_file)
+    
+    
+class DexDatabase(object):
+    VERSIONS_QUERY = """SELECT versions.id, version_names.name
+        FROM versions 
+        INNER JOIN version_names ON version_names.version_id=versions.id 
+        WHERE version_names.local_language_id=?
+        ORDER BY versions.id
+        """
+    LANGUAGES_QUERY = """SELECT id, language_names.name 
+        FROM languages 
+        INNER JOIN language_names ON language_names.language_id=languages.id 
+        WHERE language_names.local_language_id=?
+        ORDER BY languages.id
+        """
+    INFO_QUERY = """SELECT psn.name, tn1.name, tn2.name, psft.flavor_text FROM pokemon p
+        INNER JOIN pokemon_species_names psn 
+            ON psn.pokemon_species_id=p.id AND psn.local_language_id=:lang
+        INNER JOIN pokemon_species_flavor_text psft 
+            ON psft.species_id=p.id AND psft.language_id=:lang AND psft.version_id=:version
+        INNER JOIN pokemon_types pt1 
+            ON pt1.pokemon_id=p.id AND pt1.slot=1
+        INNER JOIN type_names tn1 
+            ON pt1.type_id=tn1.type_id AND tn1.local_language_id=:lang
+        LEFT JOIN pokemon_types pt2 
+            ON pt2.pokemon_id=p.id AND pt2.slot=2
+        LEFT JOIN type_names tn2 
+            ON tn2.type_id=pt2.type_id AND tn2.local_language_id=:lang
+        WHERE p.id>=:id_from AND p.id<=:id_to AND p.id=p.species_id
+        ORDER BY p.id
+        """
+    COUNT_QUERY = 'SELECT COUNT(*) FROM pokemon WHERE id=species_id'
+    
+    def __init__(self, db_file, immutable=None, mmap_size=64*1024*1024, cache_size_kb=2048):
+        if immutable is None: #the compiled db is marked read-only and never changes
+            immutable = not (os.stat(db_file).st_mode & 0o222)
+        uri = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(db_file))
+        if immutable: uri += '&immutable=1'
+        self.db_file = db_file
+        #read-only, so the connection may be handed over from the thread that loaded the dex
+        self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.conn.execute('PRAGMA mmap_size=%d' % int(mmap_size))
+        self.conn.execute('PRAGMA cache_size=%d' % -int(cache_size_kb))
+        self._count = None
+        
+    def close(self):
+        self.conn.close()
+        
+    def query_versions(self, local_language_id=9):
+        return self.conn.execute(self.VERSIONS_QUERY, (local_language_id,)).fetchall()
+        
+    def query_languages(self, local_language_id=9):
+        return self.conn.execute(self.LANGUAGES_QUERY, (local_language_id,)).fetchall()
+        
+    def query_info(self, lang_id, version_id, id_from, id_to):
+        params = {'lang': lang_id, 'version': version_id, 'id_from': id_from, 'id_to': id_to}
+        return self.conn.execute(self.INFO_QUERY, params)
+        
+    def count(self):
+        if self._count is None:
+            self._count = self.conn.execute(self.COUNT_QUERY).fetchone()[0]
+        return self._count
+        
+    def explain_info(self):
+        params = {'lang': 9, 'version': 1, 'id_from': 1, 'id_to': 1}
+        cursor = self.conn.execute('EXPLAIN QUERY PLAN ' + self.INFO_QUERY, params)
+        return [row[-1] for row in cursor.fetchall()]
+        
+    def check_query_plan(self):
+        #every table in the main join has to be looked up through an index, never scanned
+        return [step for step in self.explain_info() if not step.startswith('SEARCH')]
+    
+    
+    
 class Dex(object):
     def __init__(self, name='Unknown Dex'):
         self.name = name
         self.versions = []
         self.languages = []
         self.current_index = 1
+        self._search_index = None
         
     def get_list(self, index_from=None, index_to=None):
         if index_from is None: index_from = 0
@@ -16,6 +290,14 @@ class Dex(object):
         for i in range(index_from, index_to):
             names.append(self.get_data_of(i)['name'])
         return names
+        
+    def get_names(self, index_from=None, index_to=None):
+        return self.get_list(index_from, index_to)
+        
+    def get_window(self, index, length, margin=0):
+        index_from = max(0, index-margin)
+        index_to = min(len(self), index+length+margin)
+        return index_from, self.get_names(index_from, index_to)
     
     def set_current_entry(self, entry):
         self.current_index = entry
@@ -26,6 +308,22 @@ class Dex(object):
     
     def get_current_entry(self):
         return self.get_data_of(self.current_index)
+        
+    def get_search_index(self):
+        if self._search_index is None:
+            data = [self.get_data_of(i) for i in range(len(self))]
+            self._search_index = DexSearchIndex([d['name'] for d in data], [d['description'] for d in data])
+        return self._search_index
+        
+    def search(self, query, limit=10):
+        return self.get_search_index().search(query, limit)
+        
+    def jump_to(self, query):
+        results = self.search(query, 1)
+        if not results:
+            return None
+        self.set_current_entry(results[0])
+        return results[0]
     
     def get_image_files(self):
         raise NotImplementedError()
@@ -53,50 +351,173 @@ class Dex(object):
     
 class VeekunPokedex(Dex):
     
-    def __init__(self, version='Black', language='English', load_info=True):
+    def __init__(self, version='Black', language='English', load_info=True, info_slots=3, prewarm=False,
+                 download_url='https://veekun.com/static/pokedex/downloads/', download_checksums=None,
+                 progress=None):
         super().__init__('PokeDex')
         self.db_file = 'pokedex.sqlite'
+        self.compiled_db_file = 'pokedex.min.sqlite'
+        if os.path.isfile(self.compiled_db_file):
+            self.db_file = self.compiled_db_file
         self.img_dir = 'pokemon/global-link/'
         self.cry_dir = 'pokemon/cries/'
+        self.cache_dir = 'dex_cache/'
+        self.download_url = download_url
+        self.download_checksums = download_checksums or {}
+        self.progress = progress
 
+        self._report('Downloading', 0.)
         self._download()
-        self.conn = sqlite3.connect(self.db_file)
-        #GET VERSIONS
-        query = """SELECT versions.id, version_names.name
-        FROM versions 
-        INNER JOIN version_names ON version_names.version_id=versions.id 
-        WHERE version_names.local_language_id=9
-        """
-        cursor = self.conn.execute(query)
+        self._report('Opening database', .5)
+        self.db = DexDatabase(self.db_file)
+        self.db_stamp = self._get_db_stamp()
+        self.version = version
+        self.language = language
+        if not self._load_meta():
+            self._query_meta()
+            self._save_meta()
+        self.info_slots = max(1, info_slots)
+        self._info_tables = OrderedDict()
+        self._info_loading = {}
+        self._info_lock = threading.Lock()
+        self._prewarm_queue = queue.Queue() if prewarm else None
+        if prewarm:
+            t = threading.Thread(target=self._prewarm_loop)
+            t.daemon = True
+            t.start()
+        self._cache_info = None #so that len(self) works
+        self._report('Loading entries', .6)
+        self._cache_info = self._load_info() if load_info else None
+        
+        self._report('Indexing files', .9)
+        self.img_files = [os.path.join(self.img_dir, '%s.png' % (i+1)) for i in range(len(self))]
+        self.cry_files = [os.path.join(self.cry_dir, '%s.ogg' % (i+1)) for i in range(len(self))]
+        self._report('Ready', 1.)
+        
+    def _report(self, message, fraction):
+        if self.progress is not None:
+            self.progress(message, fraction)
+            
+    def _get_db_stamp(self):
+        stat = os.stat(self.db_file)
+        return (stat.st_mtime_ns, stat.st_size)
+        
+    def _meta_file(self):
+        return os.path.join(self.cache_dir, 'meta.json')
+        
+    def _info_file(self, version, language):
+        return os.path.join(self.cache_dir, 'info_%s_%s.bin' % 
+                            (self.version_ids[version], self.lang_ids[language]))
+        
+    def _load_meta(self):
+        try:
+            with open(self._meta_file(), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if meta.get('stamp') != list(self.db_stamp):
+            return False
+        self.versions = [ver for index,ver in meta['versions']]
+        self.version_ids = {ver: index for index,ver in meta['versions']}
+        self.languages = [lang for index,lang in meta['languages']]
+        self.lang_ids = {lang: index for index,lang in meta['languages']}
+        return True
+        
+    def _save_meta(self):
+        meta = {
+            'stamp': list(self.db_stamp),
+            'versions': [(self.version_ids[ver], ver) for ver in self.versions],
+            'languages': [(self.lang_ids[lang], lang) for lang in self.languages],
+        }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._meta_file() + '.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(self._meta_file() + '.tmp', self._meta_file())
+        except OSError as e:
+            print('Could not write dex cache: %s' % e)
+        
+    def _read_info(self, db, version, language):
+        info_file = self._info_file(version, language)
+        info = DexInfo.load(info_file, self.db_stamp)
+        if info is None:
+            cursor = db.query_info(self.lang_ids[language], self.version_ids[version], 1, db.count())
+            info = DexInfo.from_rows(cursor)
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                info.save(info_file, self.db_stamp)
+            except OSError as e:
+                print('Could not write dex cache: %s' % e)
+        return info
+        
+    def _get_info_table(self, db, version, language):
+        #LRU of info tables keyed by (version, language), shared with the prewarm thread
+        key = (version, language)
+        while True:
+            with self._info_lock:
+                if key in self._info_tables:
+                    self._info_tables.move_to_end(key)
+                    return self._info_tables[key]
+                loading = self._info_loading.get(key)
+                if loading is None:
+                    loading = self._info_loading[key] = threading.Event()
+                    break
+            loading.wait() #other thread is loading the same table
+        try:
+            info = self._read_info(db, version, language)
+            with self._info_lock:
+                self._info_tables[key] = info
+                while len(self._info_tables) > self.info_slots:
+                    self._info_tables.popitem(last=False)
+        finally:
+            with self._info_lock:
+                del self._info_loading[key]
+            loading.set()
+        return info
+        
+    def _load_info(self):
+        info = self._get_info_table(self.db, self.version, self.language)
+        if self._prewarm_queue is not None:
+            for key in self._prewarm_candidates():
+                self._prewarm_queue.put(key)
+        return info
+        
+    def _prewarm_candidates(self):
+        #adjacent versions in the current language, most likely next switch first
+        index = self.versions.index(self.version) if self.version in self.versions else 0
+        candidates = []
+        for offset in (1, -1):
+            version = self.versions[(index+offset) % len(self.versions)]
+            key = (version, self.language)
+            if version != self.version and key not in candidates:
+                candidates.append(key)
+        return candidates[:self.info_slots-1]
+        
+    def _prewarm_loop(self):
+        db = None
+        while True:
+            version, language = self._prewarm_queue.get()
+            with self._info_lock:
+                if (version, language) in self._info_tables:
+                    continue
+            if db is None: #sqlite connections can not be shared between threads
+                db = DexDatabase(self.db_file)
+            try:
+                self._get_info_table(db, version, language)
+            except Exception as e:
+                print('Could not prewarm %s/%s: %s' % (version, language, e))
+        
+    def _query_meta(self):
         self.versions = []
         self.version_ids = {}
-        for index,ver in cursor.fetchall():
+        for index,ver in self.db.query_versions():
             self.versions.append(ver)
             self.version_ids[ver] = index
-        #GET LANGUAGES
-        query = """SELECT id, language_names.name 
-        FROM languages 
-        INNER JOIN language_names ON language_names.language_id=languages.id 
-        WHERE language_names.local_language_id=9
-        """
-        cursor = self.conn.execute(query)
         self.languages = []
         self.lang_ids = {}
-        for index,lang in cursor.fetchall():
+        for index,lang in self.db.query_languages():
             self.languages.append(lang)
             self.lang_ids[lang] = index
-           
-        self.version = version
-        self.language = language
-        self._cache_info = False #so that len(self) works
-        self._cache_info = self._query_info(0, len(self)) if load_info else False
-        
-        self.img_files = []
-        self.cry_files = []
-        for i in range(len(self)):
-            self.img_files.append(os.path.join(self.img_dir, '%s.png' % (i+1)) )
-            self.cry_files.append(os.path.join(self.cry_dir, '%s.ogg' % (i+1)) )
-            
                 
     def get_image_files(self):
         return self.img_files
@@ -106,13 +527,13 @@ class VeekunPokedex(Dex):
         
     def change_language(self, language):
         self.language = language
-        if self._cache_info:
-            self._cache_info = self._query_info(0, len(self))
+        if self._cache_info is not None:
+            self._cache_info = self._load_info()
             
     def change_version(self, version):
         self.version = version
-        if self._cache_info:
-            self._cache_info = self._query_info(0, len(self))
+        if self._cache_info is not None:
+            self._cache_info = self._load_info()
     
     def _query_info(self, index, index_to=None):
         if index_to is None:
@@ -120,40 +541,16 @@ class VeekunPokedex(Dex):
             index_to = index+1
         else: single_value = False
             
-        pkmn_id = index+1
-        pkmn_id_to = index_to
-            
-        query = """ SELECT psn.name, tn1.name, tn2.name, psft.flavor_text FROM pokemon p
-        INNER JOIN pokemon_species_names psn 
-            ON psn.pokemon_species_id=p.id AND psn.local_language_id={2}
-        INNER JOIN pokemon_species_flavor_text psft 
-            ON psft.species_id=p.id AND psft.language_id={2} AND psft.version_id={3}
-        INNER JOIN pokemon_types pt1 
-            ON pt1.pokemon_id=p.id AND pt1.slot=1
-        INNER JOIN type_names tn1 
-            ON pt1.type_id=tn1.type_id AND tn1.local_language_id={2}
-        LEFT JOIN pokemon_types pt2 
-            ON pt2.pokemon_id=p.id AND pt2.slot=2
-        LEFT JOIN type_names tn2 
-            ON tn2.type_id=pt2.type_id AND tn2.local_language_id={2}
-        WHERE p.id>={0} AND p.id<={1} AND p.id=p.species_id
-        """.format(pkmn_id, pkmn_id_to, self.lang_ids[self.language], self.version_ids[self.version])
-        cursor = self.conn.execute(query)
-        infos = []
-        for pkmn in cursor.fetchall():
-            infos.append({
-                'name': pkmn[0],
-                'description': pkmn[3],
-                'type1': pkmn[1],
-                'type2': pkmn[2],
-            })
-        if single_value: return infos[0]
+        cursor = self.db.query_info(self.lang_ids[self.language], self.version_ids[self.version], 
+                                    index+1, index_to)
+        infos = DexInfo.from_rows(cursor)
+        if single_value: return DexInfoEntry(infos, 0)
         else: return infos
             
     
     def _get_info(self, index):
-        if self._cache_info:
-            return self._cache_info[index]
+        if self._cache_info is not None:
+            return DexInfoEntry(self._cache_info, index)
         return self._query_info(index)
                 
     def get_sprite_of(self, index):
@@ -170,74 +567,53 @@ class VeekunPokedex(Dex):
         
         data = {}
         data['id'] = index+1
-        data['name'] = info['name']
-        data['description'] = info['description']
-        data['type1'] = info['type1']
-        data['type2'] = info['type2']
+        data['name'] = info.name
+        data['description'] = info.description
+        data['type1'] = info.type1
+        data['type2'] = info.type2
         data['image'] = sprite
         data['sound'] = cry
         return data
+        
+    def get_search_index(self):
+        key = (self.version, self.language)
+        if self._search_index is None or self._search_key != key:
+            info = self._cache_info
+            if info is None:
+                info = self._query_info(0, len(self))
+            descriptions = (info.get_description(i) for i in range(len(info)))
+            self._search_index = DexSearchIndex(info.names, descriptions)
+            self._search_key = key
+        return self._search_index
+        
+    def get_list(self, index_from=None, index_to=None):
+        return self.get_names(index_from, index_to)
+        
+    def get_names(self, index_from=None, index_to=None):
+        if index_from is None: index_from = 0
+        if index_to is None: index_to = len(self)
+        if self._cache_info is not None:
+            return self._cache_info.names_in_range(index_from, index_to)
+        return self._query_info(index_from, index_to).names
     
     
     
     def __len__(self):
-        if self._cache_info:
+        if self._cache_info is not None:
             return len(self._cache_info)
-        cursor = self.conn.execute('SELECT id FROM pokemon WHERE id=species_id')
-        return len(cursor.fetchall())
+        return self.db.count()
 
 
     def _download(self):
+        jobs = []
         if not os.path.isfile(self.db_file):
-            zip_file = 'veekun-pokedex.sqlite.gz'
-            if not os.path.isfile(zip_file):
-                print('Downloading DB')
-                url = 'https://veekun.com/static/pokedex/downloads/veekun-pokedex.sqlite.gz'
-                response = urllib.request.urlopen(url)
-                f = open(zip_file, 'wb+')
-                f.write(response.read())
-                f.close()
-
-            print('Unzipping DB')
-            db_filedata = gzip.GzipFile(zip_file, mode='rb')
-            db_file = open(self.db_file, 'wb+')
-            db_file.write(db_filedata.read())
-            db_file.close()
-
+            jobs.append(self._download_job('veekun-pokedex.sqlite.gz', lambda f: download.gunzip(f, self.db_file)))
         if not os.path.isdir(self.img_dir):
-            zip_file = 'pokemon-global-link.tar.gz'
-            if not os.path.isfile(zip_file):
-                print('Downloading images')
-                url = 'https://veekun.com/static/pokedex/downloads/pokemon-global-link.tar.gz'
-                response = urllib.request.urlopen(url)
-                f = open(zip_file, 'wb+')
-                f.write(response.read())
-                f.close()
-
-            print('Unzipping images')
-            fileobj = tarfile.open(zip_file, mode='r:gz')
-            fileobj.extractall()
-            fileobj.close()
-
+            jobs.append(self._download_job('pokemon-global-link.tar.gz', lambda f: download.untar(f, self.img_dir)))
         if not os.path.isdir(self.cry_dir):
-            zip_file = 'pokemon-cries.tar.gz'
-            if not os.path.isfile(zip_file):
-                print('Downloading cries')
-                url = 'https://veekun.com/static/pokedex/downloads/pokemon-cries.tar.gz'
-                response = urllib.request.urlopen(url)
-                f = open(zip_file, 'wb+')
-                f.write(response.read())
-                f.close()
-
-            print('Unzipping cries')
-            fileobj = tarfile.open(zip_file, mode='r:gz')
-            fileobj.extractall()
-            fileobj.close()
-
-
-
-
-
-
-
-
+            jobs.append(self._download_job('pokemon-cries.tar.gz', lambda f: download.untar(f, self.cry_dir)))
+        download.fetch_all(jobs, progress=lambda done, total: self._report('Downloading', .5*done/total))
+        
+    def _download_job(self, archive, extract):
+        url = urllib.parse.urljoin(self.download_url, archive)
+        return (url, archive, extract, self.download_checksums.get(archive))
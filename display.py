@@ -1,4 +1,7 @@
-import os
+import os, sys, mmap, struct, json, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
 
 try:
     import pygame
@@ -9,23 +12,135 @@ except ImportError: pass
 class Display(object):
     def display(self, menu):
         raise NotImplementedError()
-    def preload_images(self, files):
+    def preload_images(self, files, workers=None, progress=None):
         raise NotImplementedError()
     def load_image(self, imgpath):
         raise NotImplementedError()
+    def prefetch_images(self, files):
+        pass
     def get_mouse_pos(self):
         raise NotImplementedError()
     def draw_text(self, text, pos, color, font_id=0, centered=False):
         raise NotImplementedError()
+    def get_text_size(self, text, font_id=0):
+        raise NotImplementedError()
     def draw_rect(self, rect, color):
         raise NotImplementedError()
     def draw_image(self, pos, image):
         raise NotImplementedError()
+    def get_size(self):
+        raise NotImplementedError()
+
 
+#16 bit screens like the /dev/fb1 panel have no frombuffer format, their sprites are kept as raw surface bytes
+PACKED_FORMATS = {
+    'RGB565': (16, (0xf800, 0x7e0, 0x1f, 0)),
+    'RGB555': (15, (0x7c00, 0x3e0, 0x1f, 0)),
+}
 
+def get_pixel_format(surface, exact=False):
+    #format whose bytes match the surface, so blits from the atlas are plain copies
+    #without a match RGBX is used and pygame converts on every blit, or None with exact
+    if surface is not None and surface.get_bytesize() == 4 and sys.byteorder == 'little':
+        masks = tuple(surface.get_masks()[:3])
+        if masks == (0xff0000, 0xff00, 0xff):
+            return 'BGRA'
+        if masks == (0xff, 0xff00, 0xff0000):
+            return 'RGBX'
+    if surface is not None and surface.get_bytesize() == 2:
+        for pixel_format, (depth, masks) in PACKED_FORMATS.items():
+            if surface.get_bitsize() == depth and tuple(surface.get_masks()[:3]) == masks[:3]:
+                return pixel_format
+    return None if exact else 'RGBX'
+    
+def image_bytes(size, pixel_format):
+    if pixel_format in PACKED_FORMATS:
+        depth, masks = PACKED_FORMATS[pixel_format]
+        return pygame.Surface(size, 0, depth, masks).get_pitch() * size[1]
+    return size[0]*size[1]*len(pixel_format)
+    
+def image_to_bytes(surface, pixel_format):
+    if pixel_format in PACKED_FORMATS:
+        depth, masks = PACKED_FORMATS[pixel_format]
+        packed = pygame.Surface(surface.get_size(), 0, depth, masks)
+        packed.blit(surface, (0,0))
+        return packed.get_buffer().raw
+    return pygame.image.tostring(surface, pixel_format)
+    
+def image_from_bytes(data, size, pixel_format):
+    #frombuffer formats are used in place, packed ones are copied into a new surface
+    if pixel_format in PACKED_FORMATS:
+        depth, masks = PACKED_FORMATS[pixel_format]
+        surface = pygame.Surface(size, 0, depth, masks)
+        surface.get_buffer().write(bytes(data))
+        return surface
+    return pygame.image.frombuffer(data, size, pixel_format)
+    
+    
+class SpriteAtlas(object):
+    #one file: magic, json index length, json index, then fixed size raw sprites at page aligned offsets
+    MAGIC = b'PIDEXATL'
+    HEADER = struct.Struct('=8sI')
+    
+    def __init__(self, atlas_file):
+        with open(atlas_file, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_len = self.HEADER.unpack_from(self.buf, 0)
+        if magic != self.MAGIC:
+            raise ValueError('%s is not a sprite atlas' % atlas_file)
+        index = json.loads(bytes(self.buf[self.HEADER.size:self.HEADER.size+index_len]))
+        self.size = tuple(index['size'])
+        self.format = index['format']
+        self.sprite_bytes = index['sprite_bytes']
+        self.offsets = index['offsets']
+        self.view = memoryview(self.buf)
+        self._surfaces = {}
+        
+    def __contains__(self, path):
+        return path in self.offsets
+        
+    def get(self, path):
+        surface = self._surfaces.get(path)
+        if surface is None:
+            offset = self.offsets[path]
+            data = self.view[offset:offset+self.sprite_bytes]
+            surface = self._surfaces[path] = image_from_bytes(data, self.size, self.format)
+        return surface
+        
+    @classmethod
+    def build(cls, files, atlas_file, size=(180,180), pixel_format='RGBX', missing_file='unknown.png'):
+        sprites = []
+        offsets = {}
+        sprite_offsets = {}
+        sprite_bytes = image_bytes(size, pixel_format)
+        for filepath in files:
+            source = filepath if os.path.isfile(filepath) else missing_file
+            if source not in sprite_offsets:
+                sprite_offsets[source] = len(sprites)
+                sprites.append(source)
+            offsets[filepath] = sprite_offsets[source]
+        index = {'size': size, 'format': pixel_format, 'sprite_bytes': sprite_bytes, 'offsets': offsets}
+        #offsets in the index are placeholders until the data start is known
+        index_len = len(json.dumps(dict(index, offsets={f: 2**40 for f in offsets})).encode('utf-8'))
+        data_start = -(-(cls.HEADER.size + index_len) // mmap.PAGESIZE) * mmap.PAGESIZE
+        index['offsets'] = {f: data_start + i*sprite_bytes for f,i in offsets.items()}
+        index_data = json.dumps(index).encode('utf-8')
+        tmp_file = atlas_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(index_data)))
+            f.write(index_data)
+            f.write(b'\0' * (data_start - f.tell()))
+            for source in sprites:
+                img = pygame.transform.scale(pygame.image.load(source), size)
+                f.write(image_to_bytes(img, pixel_format))
+        os.replace(tmp_file, atlas_file)
+        return len(sprites)
+        
+        
 class PygameDisplay(Display):
         
-    def __init__(self, size):
+    def __init__(self, size, text_cache_size=512, dirty_rects=True, background=(255,255,255),
+                 atlas_file='sprites.atlas', image_cache_bytes=16*1024*1024, prefetch_workers=2):
         pygame.display.init()
         pygame.font.init()
         pygame.mouse.set_cursor((8,8),(0,0),(0,0,0,0,0,0,0,0),(0,0,0,0,0,0,0,0))
@@ -37,52 +152,188 @@ class PygameDisplay(Display):
             pygame.font.SysFont('Arial Black', 20, bold=False, italic=False),
             pygame.font.SysFont('Arial', 15, bold=True, italic=False),
         ]
-        self._text_cache = {}
-        self._img_cache = {}
+        self._text_cache = LRUCache(text_cache_size)
+        self._img_cache = LRUCache(image_cache_bytes, 
+                                   size_of=lambda img: img.get_width()*img.get_height()*img.get_bytesize())
+        self._img_preloaded = {}
+        self._preloader = None
+        self._preview_surface = None
+        self._preview_source = None
+        self._img_loading = {}
+        self._img_lock = threading.Lock()
+        self._img_pool = ThreadPoolExecutor(max_workers=prefetch_workers) if prefetch_workers else None
+        self.atlas = None
+        if atlas_file is not None and os.path.isfile(atlas_file):
+            try:
+                self.atlas = SpriteAtlas(atlas_file)
+            except (OSError, ValueError) as e:
+                print('Could not open sprite atlas: %s' % e)
+        self.background = background
+        self.dirty_rects = dirty_rects
+        #draw calls of the current and the last frame as (key, rect, surface or fill color)
+        self._ops = []
+        self._last_ops = None
+        self.screen.fill(self.background)
         
     
     def display(self):
-        pygame.display.flip()
-        self.screen.fill((255,255,255))
+        if not self.dirty_rects:
+            pygame.display.flip()
+            self.screen.fill(self.background)
+            return
+        ops, self._ops = self._ops, []
+        screen_rect = self.screen.get_rect()
+        if self._last_ops is None:
+            dirty = [screen_rect]
+        else:
+            #a draw call with the same key at the same place as last frame left its region unchanged
+            previous = {(key, rect) for key, rect, source in self._last_ops if key is not None}
+            current = {(key, rect) for key, rect, source in ops if key is not None}
+            dirty = [pygame.Rect(rect) for key, rect, source in ops if key is None or (key, rect) not in previous]
+            dirty += [pygame.Rect(rect) for key, rect, source in self._last_ops 
+                      if key is None or (key, rect) not in current]
+        dirty = [rect.clip(screen_rect) for rect in dirty]
+        dirty = [rect for rect in dirty if rect.width > 0 and rect.height > 0]
+        for rect in dirty:
+            self.screen.set_clip(rect)
+            self.screen.fill(self.background)
+            for key, op_rect, source in ops:
+                if rect.colliderect(op_rect):
+                    if isinstance(source, pygame.Surface):
+                        self.screen.blit(source, op_rect[:2])
+                    else:
+                        self.screen.fill(source, op_rect)
+        self.screen.set_clip(None)
+        if dirty:
+            pygame.display.update(dirty)
+        self._last_ops = ops
         
-    def preload_images(self, files):
-        for filepath in files:
-            if not os.path.isfile(filepath):
-                filepath = 'unknown.png'
-            img = pygame.image.load(filepath).convert()
-            self._img_cache[filepath] = pygame.transform.scale(img, (180,180))
+    def invalidate(self):
+        self._last_ops = None
         
-    def load_image(self, imgpath):
-        if imgpath in self._img_cache:
-            return self._img_cache[imgpath]
+    def _blit(self, surface, pos, key):
+        if not self.dirty_rects:
+            self.screen.blit(surface, pos)
+            return
+        #the op keeps a reference to the surface, so its id can not be reused while it is compared
+        rect = (int(pos[0]), int(pos[1]), surface.get_width(), surface.get_height())
+        self._ops.append((key, rect, surface))
+        
+    def preload_images(self, files, workers=None, progress=None):
+        if workers:
+            from preload import ParallelPreloader
+            if self._preloader is None:
+                self._preloader = ParallelPreloader(workers)
+            self._img_preloaded.update(self._preloader.load_images(
+                files, (180,180), get_pixel_format(self.screen), progress=progress))
+            return
+        for done, filepath in enumerate(files, 1):
+            self.load_image(filepath)
+            if progress is not None:
+                progress(done, len(files))
+            
+    def _decode_image(self, imgpath):
+        if not os.path.isfile(imgpath):
+            imgpath = 'unknown.png'
         return pygame.transform.scale(pygame.image.load(imgpath), (180,180)).convert()
+        
+    def _prefetch_image(self, imgpath):
+        try:
+            self._img_cache.put(imgpath, self._decode_image(imgpath))
+        finally:
+            with self._img_lock:
+                del self._img_loading[imgpath]
+        
+    def prefetch_images(self, files):
+        if self._img_pool is None:
+            return
+        for imgpath in files:
+            if imgpath in self._img_cache or (self.atlas is not None and imgpath in self.atlas):
+                continue
+            with self._img_lock:
+                if imgpath not in self._img_loading:
+                    self._img_loading[imgpath] = self._img_pool.submit(self._prefetch_image, imgpath)
+        
+    def load_image(self, imgpath):
+        img = self._img_preloaded.get(imgpath)
+        if img is not None:
+            return img
+        img = self._img_cache.get(imgpath)
+        if img is not None:
+            return img
+        if self.atlas is not None and imgpath in self.atlas:
+            return self.atlas.get(imgpath)
+        with self._img_lock:
+            loading = self._img_loading.get(imgpath)
+        if loading is not None: #already being decoded by the prefetcher
+            loading.result()
+            img = self._img_cache.get(imgpath)
+            if img is not None:
+                return img
+        return self._img_cache.put(imgpath, self._decode_image(imgpath))
     
     def get_mouse_pos(self):
         return pygame.mouse.get_pos()
     
+    def get_cache_stats(self):
+        return {'text': self._text_cache.stats(), 'image': self._img_cache.stats()}
+    
+    
+    def render_text(self, text, color, font_id=0):
+        key = (text, font_id, tuple(color))
+        cached = self._text_cache.get(key)
+        if cached is None:
+            text_surface = self.fonts[font_id].render(text, False, color)
+            cached = self._text_cache.put(key, (text_surface, text_surface.get_width(), text_surface.get_height()))
+        return cached
     
     def draw_text(self, text, pos, color, font_id=0, anchor=None):
-        #if text not in self._text_cache:
-        #    self._text_cache[text] = self.font.render(text, False, color)
-        #self.screen.blit(self._text_cache[text], pos)
-        text_surface = self.fonts[font_id].render(text, False, color)
+        text_surface, width, height = self.render_text(text, color, font_id)
         if anchor is not None:
             pos = [pos[0],pos[1]]
             if anchor[0] == 'mid':
-                pos[0] = pos[0]-text_surface.get_width()//2
+                pos[0] = pos[0]-width//2
             elif anchor[0] == 'right':
-                pos[0] = pos[0]-text_surface.get_width()
+                pos[0] = pos[0]-width
             if anchor[1] == 'mid':
-                pos[1] = pos[1]-text_surface.get_height()//2
+                pos[1] = pos[1]-height//2
             elif anchor[1] == 'bottom':
-                pos[1] = pos[1]-text_surface.get_height()
-        self.screen.blit(text_surface, pos)
+                pos[1] = pos[1]-height
+        self._blit(text_surface, pos, id(text_surface))
+    
+    def get_text_size(self, text, font_id=0):
+        return self.fonts[font_id].size(text)
     
     def draw_rect(self, rect, color):
-        pygame.draw.rect(self.screen, color, pygame.Rect(rect[0],rect[1],rect[2],rect[3]))
+        if not self.dirty_rects:
+            pygame.draw.rect(self.screen, color, pygame.Rect(rect[0],rect[1],rect[2],rect[3]))
+            return
+        rect = (int(rect[0]), int(rect[1]), int(rect[2]), int(rect[3]))
+        self._ops.append((('rect', tuple(color)), rect, tuple(color)))
     
     def draw_image(self, pos, image):
         if not isinstance(image, pygame.Surface):
-            image = pygame.surfarray.make_surface(image)
-        self.screen.blit(image, pos)
+            self._blit(self._get_preview_surface(image), pos, None) #new content every call
+            return
+        self._blit(image, pos, id(image))
+        
+    def _get_preview_surface(self, image):
+        #arrays are camera frames in surfarray (x,y) layout, shown through one persistent surface
+        size = image.shape[:2]
+        rows = image.transpose(1,0,2)
+        if rows.flags.c_contiguous and rows.dtype.itemsize == 1 and rows.shape[2] == 3:
+            #a transposed row-major buffer, the surface can wrap its memory without copying
+            key = (rows.__array_interface__['data'][0], size)
+            if self._preview_source != key:
+                self._preview_surface = pygame.image.frombuffer(rows, size, 'RGB')
+                self._preview_source = key
+            return self._preview_surface
+        if self._preview_source is not None or self._preview_surface is None or self._preview_surface.get_size() != size:
+            self._preview_surface = pygame.Surface(size).convert()
+            self._preview_source = None
+        pygame.surfarray.blit_array(self._preview_surface, image)
+        return self._preview_surface
+        
+    def get_size(self):
+        return self.screen.get_size()
     
\ No newline at end of file
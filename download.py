@@ -0,0 +1,87 @@
+import os, shutil, hashlib
+import gzip, tarfile
+import urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+
+CHUNK_SIZE = 64*1024
+
+
+def sha256_of(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download(url, path, sha256=None, chunk_size=CHUNK_SIZE, timeout=30):
+    #downloads into path.part and resumes it with a Range request after an interruption
+    part_path = path + '.part'
+    pos = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    request = urllib.request.Request(url)
+    if pos:
+        request.add_header('Range', 'bytes=%d-' % pos)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code != 416: #416: nothing left after pos, the part file is complete
+            raise
+        response = None
+    if response is not None:
+        with response:
+            if pos and response.status != 206: #server ignored the range, start over
+                pos = 0
+            with open(part_path, 'ab' if pos else 'wb') as f:
+                shutil.copyfileobj(response, f, chunk_size)
+    if sha256 is not None and sha256_of(part_path, chunk_size) != sha256:
+        os.remove(part_path)
+        raise ValueError('Checksum mismatch for %s' % url)
+    os.replace(part_path, path)
+
+
+def gunzip(src, dst, chunk_size=CHUNK_SIZE):
+    tmp = dst + '.part'
+    with gzip.open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, chunk_size)
+    os.replace(tmp, dst)
+
+
+def untar(src, target_dir):
+    #extracts the stream into a temporary directory and moves target_dir in place once complete
+    tmp = '.%s.extract' % os.path.basename(src)
+    shutil.rmtree(tmp, ignore_errors=True)
+    with tarfile.open(src, mode='r|gz') as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(tmp, filter='data')
+        else:
+            tar.extractall(tmp)
+    extracted = os.path.join(tmp, target_dir)
+    if os.path.isdir(extracted):
+        parent = os.path.dirname(os.path.normpath(target_dir))
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        os.replace(extracted, os.path.normpath(target_dir))
+    else:
+        shutil.copytree(tmp, '.', dirs_exist_ok=True)
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def fetch(url, archive, extract, sha256=None):
+    if not os.path.isfile(archive):
+        print('Downloading %s' % archive)
+        download(url, archive, sha256)
+    print('Unpacking %s' % archive)
+    extract(archive)
+
+
+def fetch_all(jobs, max_workers=3, progress=None):
+    #jobs are fetch() argument tuples, downloaded and unpacked concurrently
+    if not jobs:
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(fetch, *job) for job in jobs]
+        for done, future in enumerate(futures, 1):
+            future.result()
+            if progress is not None:
+                progress(done, len(futures))
@@ -8,24 +8,47 @@ def get_display(size):
 
 def get_audio():
     from audio import PygameAudio as Audio
-    return Audio()
+    #the most recently played cries are kept decoded next to the other dex caches, raw pcm is ~10x the ogg size
+    return Audio(pcm_dir='dex_cache/cries/', pcm_bytes=16*1024*1024)
 
 def get_controller():
     from controller import PygameController as Controller
     return Controller()
 
 def get_camera():
-    from camera import OpenCVCamera as Camera
-    return Camera()
+    from camera import OpenCVCamera, ThreadedCamera
+    #capture runs on its own thread while the scanner is shown, the ui only picks up the newest frame
+    return ThreadedCamera(OpenCVCamera())
 
-def get_dex():
+def get_dex(progress=None):
     from dex import VeekunPokedex as Dex
-    return Dex()
+    return Dex(prewarm=True, progress=progress)
 
 def get_menu(dex, display, audio, camera):
     from menu import MainMenu as Menu
     return Menu(dex, display, audio, camera)
 
+def get_scheduler():
+    from scheduler import FrameScheduler as Scheduler
+    return Scheduler(max_fps=30.)
+
+def get_loader(display, audio, preload=False):
+    def load(progress):
+        dex = get_dex(progress)
+        if preload: #decode all sprites and cries on every core
+            workers = os.cpu_count()
+            display.preload_images(dex.get_image_files(), workers, 
+                                   lambda done, total: progress('Preloading images', done/total))
+            audio.preload_files(dex.get_sound_files(), workers, 
+                                lambda done, total: progress('Preloading cries', done/total))
+        return dex
+    return load
+
+def get_loading_menu(display, audio, camera, preload=False):
+    from menu import LoadingMenu as Menu
+    return Menu(get_loader(display, audio, preload), lambda dex: get_menu(dex, display, audio, camera), 
+                display, audio, camera)
+
 
 
 def main():
@@ -46,33 +69,31 @@ def main():
     controller = get_controller()
     camera = get_camera()
     
-    #data
-    dex = get_dex()
+    #data is loaded and optionally preloaded in the background, the main menu is connected once the dex is ready
+    menu = get_loading_menu(display, audio, camera, preload=False)
     
-    #connect everything
-    menu = get_menu(dex, display, audio, camera)
-    
-    #preload
-    #display.preload_images(dex.get_image_files())
-    #audio.preload_files(dex.get_sound_files())
+    scheduler = get_scheduler()
     
     print('Running PokeDex')
     start_time = time.time()
     while True:
-        time.sleep(0.001)
+        actions = scheduler.wait(controller, menu)
         end_time = time.time()
         delta_time = end_time - start_time
         start_time = end_time
         
-        actions = controller.get_actions()
         next_menu = menu.update(delta_time, actions)
         if next_menu is not None: 
             menu = next_menu
             menu.enter()
         if menu.quit or A.QUIT in actions: break
-        menu.render()
-        display.display()
-        
+        if scheduler.should_render():
+            menu.render()
+            display.display()
+            scheduler.rendered()
+    
+    from recognition import close_scan_pool
+    close_scan_pool()
         
 
 
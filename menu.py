@@ -1,9 +1,13 @@
 
-import subprocess
+import subprocess, threading, traceback
 
 from controller import Actions as A
 
 
+def neighbour_indices(index, count, offsets=(1, -1, 2, -2)):
+    return [(index+offset) % count for offset in offsets if count > 0]
+
+
 class Menu(object):
     def __init__(self, dex, display, audio, camera):
         self.dex = dex
@@ -12,8 +16,11 @@ class Menu(object):
         self.camera = camera
         self.previous_menu = self
         self.quit = False
+        self.refresh_rate = 0 #redraws per second without input, 0 redraws only on input
     def update(self, delta_time, actions):
         raise NotImplementedError()
+    def get_refresh_rate(self):
+        return self.refresh_rate
     def render(self):
         raise NotImplementedError()
     def enter(self): pass
@@ -21,6 +28,46 @@ class Menu(object):
         menu.previous_menu = self
         return menu
         
+class LoadingMenu(Menu):
+    def __init__(self, load_dex, make_menu, display, audio, camera):
+        super().__init__(None, display, audio, camera)
+        self.make_menu = make_menu
+        self.status = ('Starting', 0.)
+        self.refresh_rate = 10
+        self.error = None
+        self.loaded_dex = None
+        self.thread = threading.Thread(target=self.load, args=(load_dex,))
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def load(self, load_dex):
+        try:
+            self.loaded_dex = load_dex(progress=self.report)
+        except Exception as e:
+            traceback.print_exc()
+            self.error = str(e) or type(e).__name__
+            
+    def report(self, message, fraction):
+        self.status = (message, fraction)
+        
+    def update(self, delta_time, actions):
+        if self.loaded_dex is not None:
+            self.dex = self.loaded_dex
+            return self.make_menu(self.dex)
+        if self.error is not None and (A.MENU_OK in actions or A.MENU_LEFT in actions):
+            self.quit = True
+            
+    def render(self):
+        self.display.draw_text("Loading", (10,10), (50,100,50))
+        if self.error is not None:
+            self.display.draw_text(self.error, (30,60), (250,10,100), font_id=4)
+            return
+        message, fraction = self.status
+        self.display.draw_text(message, (30,60), (10,10,10), font_id=1)
+        self.display.draw_rect((30,100,420,20), (200,200,200))
+        self.display.draw_rect((30,100,int(420*max(0., min(1., fraction))),20), (250,10,100))
+        
+        
 class QuitMenu(Menu):
     def __init__(self, dex, display, audio, camera):
         super().__init__(dex, display, audio, camera)
@@ -74,35 +121,109 @@ class MainMenu(Menu):
         
         
 class DexScanner(Menu):
-    def __init__(self, dex, display, audio, camera):
+    def __init__(self, dex, display, audio, camera, auto_scan=True, scan_roi=None, auto_min_score=0.7):
         super().__init__(dex, display, audio, camera)
         self.entry_lister = DexEntryLister(dex, display, audio, camera, auto_speech=True)
-        self.fps = 5.0
+        self.fps = 15.0
         self.delta_time = 1./self.fps + 1.
         self.img = None
+        self.scan_job = None
+        self.scan_auto = False
+        self.scan_time = 0.
+        self.scan_roi = scan_roi
+        self.auto_min_score = auto_min_score
+        self.gate = None
+        self.frame_time = None
+        if auto_scan:
+            from recognition import StabilityGate
+            self.gate = StabilityGate(roi=scan_roi)
+        
+    def enter(self):
+        self.camera.start()
+        
+    def leave(self, menu):
+        #the camera only captures while the scanner is on screen, the scan worker goes after a while
+        self.camera.pause()
+        if self.scan_job is not None:
+            self.cancel_scan()
+        from recognition import release_scan_pool
+        release_scan_pool()
+        self.img = None
+        return menu
+        
+    def get_refresh_rate(self):
+        return self.fps
         
     def update(self, delta_time, actions):
 
         self.delta_time += delta_time
         if self.delta_time >= 1./self.fps:
-            self.img = self.camera.get_img()
+            self.img = self.camera.get_img(self.display.get_size())
             self.delta_time -= 1./self.fps
+            if self.gate is not None and self.scan_job is None:
+                self.check_stable()
+
+        if self.scan_job is not None:
+            self.scan_time += delta_time
+            if self.scan_job.done():
+                job, self.scan_job = self.scan_job, None
+                try:
+                    index, score = job.result()[0]
+                except Exception:
+                    traceback.print_exc()
+                else:
+                    #a weak auto scan means nothing recognisable is in view, wait for the next still scene
+                    if not (self.scan_auto and score < self.auto_min_score):
+                        self.dex.set_current_entry(index)
+                        return self.leave(self.swap_menu(self.entry_lister))
 
         if A.MENU_OK in actions or A.MENU_RIGHT in actions:
             if self.img is not None: 
-                index = self.scan()
-                self.dex.set_current_entry(index)
-                return self.swap_menu(self.entry_lister)
+                self.start_scan()
         elif A.MENU_LEFT in actions:
-            return self.previous_menu
+            if self.scan_job is not None:
+                self.cancel_scan()
+            else:
+                return self.leave(self.previous_menu)
             
     def render(self):
         #self.display.draw_text("Scanner", (10,10), (50,100,50))
         if self.img is not None:
             self.display.draw_image((0,0), self.img)
+        if self.scan_job is not None:
+            dots = '.' * (int(self.scan_time*4) % 4)
+            self.display.draw_text("Scanning" + dots, (10,10), (250,10,100))
+        
+    def get_scanner(self):
+        from recognition import get_scan_pool
+        return get_scan_pool(self.dex.get_image_files())
+        
+    def check_stable(self):
+        #only frames the camera has not delivered before count towards stability
+        stamp, frame = self.camera.get_latest()
+        if frame is None or stamp == self.frame_time:
+            return
+        self.frame_time = stamp
+        if self.gate.update(frame):
+            self.start_scan(frame, auto=True)
+        
+    def start_scan(self, frame=None, auto=False):
+        #match the raw camera frame, the preview is scaled and turned for the screen
+        if frame is None:
+            frame = self.camera.read()
+        if frame is None:
+            return
+        if self.scan_roi is not None:
+            x,y,w,h = self.scan_roi
+            frame = frame[y:y+h, x:x+w]
+        self.scan_job = self.get_scanner().submit(frame, k=1)
+        self.scan_auto = auto
+        self.scan_time = 0.
         
-    def scan(self):
-        return 50
+    def cancel_scan(self):
+        #a job that already runs can not be stopped, its result is just dropped
+        self.scan_job.cancel()
+        self.scan_job = None
         
 
 class DexLister(Menu):
@@ -110,21 +231,35 @@ class DexLister(Menu):
         super().__init__(dex, display, audio, camera)
         self.entry_lister = DexEntryLister(dex, display, audio, camera, auto_cry=True)
         self.submenu_scanner = DexScanner(dex, display, audio, camera)
+        self.submenu_search = DexSearch(dex, display, audio, camera)
         self.cursor = 0
         self.cursor_submenu = 0
-        self.submenus = 2
+        self.submenus = 3
         self.view_start = 0
         self.view_len = 8
-        self.prev_names_len = 0
+        self.view_prefetch = 16
+        self.names_start = 0
+        self.names = None
+        self.count = 0
+        self.prev_count = 0
         self.last_played_wav = -1
         self.last_img = -1
         
     def enter(self):
         self.audio.stop()
-        self.names = self.dex.get_list()
-        if self.cursor < 0 or self.prev_names_len != len(self.names):
+        self.count = len(self.dex)
+        if self.cursor < 0 or self.prev_count != self.count:
             self.cursor = 0
-        self.prev_names_len = len(self.names)
+            self.view_start = 0
+        self.prev_count = self.count
+        self.names = None #names may have changed with the language
+        self.load_names()
+        
+    def load_names(self):
+        view_end = min(self.count, self.view_start+self.view_len)
+        if (self.names is None or self.view_start < self.names_start 
+                or view_end > self.names_start+len(self.names)):
+            self.names_start, self.names = self.dex.get_window(self.view_start, self.view_len, self.view_prefetch)
         
     def update(self, delta_time, actions):
         if A.MENU_OK in actions:
@@ -133,6 +268,8 @@ class DexLister(Menu):
                     return self.previous_menu
                 elif self.cursor_submenu == 1:
                     return self.swap_menu(self.submenu_scanner)
+                elif self.cursor_submenu == 2:
+                    return self.swap_menu(self.submenu_search)
             else:
                 self.dex.set_current_entry(self.cursor)
                 return self.swap_menu(self.entry_lister)
@@ -149,15 +286,15 @@ class DexLister(Menu):
             else:
                 self.cursor += self.view_len
                 self.view_start += self.view_len
-                if self.cursor >= len(self.names): self.cursor = len(self.names)-1
+                if self.cursor >= self.count: self.cursor = self.count-1
         elif A.MENU_UP in actions:
             if self.cursor < 0: 
-                self.cursor = len(self.names)-1
+                self.cursor = self.count-1
             else:
                 self.cursor -= 1
         elif A.MENU_DOWN in actions:
             self.cursor += 1
-            if self.cursor >= len(self.names):
+            if self.cursor >= self.count:
                 self.cursor = -1
                 self.view_start = 0
                 
@@ -165,20 +302,30 @@ class DexLister(Menu):
             self.view_start = self.cursor
         elif self.cursor >= self.view_start+self.view_len:
             self.view_start = self.cursor - self.view_len +1
-        self.view_start = max(0, min(len(self.names)-self.view_len, self.view_start))
+        self.view_start = max(0, min(self.count-self.view_len, self.view_start))
+        self.load_names()
+        if actions and self.cursor >= 0:
+            offsets = (1, -1, 2, -2, self.view_len, -self.view_len)
+            self.display.prefetch_images([self.dex.get_sprite_of(i) 
+                                          for i in neighbour_indices(self.cursor, self.count, offsets)])
+            self.audio.prefetch_sounds([self.dex.get_sound_of(i) 
+                                        for i in neighbour_indices(self.cursor, self.count, offsets)])
         
         
     def render(self):
         self.display.draw_text(self.dex.name, (10,10), (50,100,50))
-        self.display.draw_text("Back", (350,10), (250,10,100) if self.cursor<0 and self.cursor_submenu == 0 
+        self.display.draw_text("Back", (340,10), (250,10,100) if self.cursor<0 and self.cursor_submenu == 0 
+                               else (10,10,10), font_id=1)
+        self.display.draw_text("Scan", (385,10), (250,10,100) if self.cursor<0 and self.cursor_submenu == 1 
                                else (10,10,10), font_id=1)
-        self.display.draw_text("Scan", (400,10), (250,10,100) if self.cursor<0 and self.cursor_submenu == 1 
+        self.display.draw_text("Find", (430,10), (250,10,100) if self.cursor<0 and self.cursor_submenu == 2 
                                else (10,10,10), font_id=1)
         x,y = 350,60
         counter = 0
-        for i in range(self.view_len):
+        for i in range(min(self.view_len, self.count)):
             color = (250,10,100) if counter == self.cursor-self.view_start else (10,10,10)
-            self.display.draw_text(self.names[i+self.view_start], (x,y), color, font_id=1, anchor=('left','mid'))
+            name = self.names[i+self.view_start-self.names_start]
+            self.display.draw_text(name, (x,y), color, font_id=1, anchor=('left','mid'))
             self.display.draw_text(str(i+self.view_start+1), (x-25,y), color, font_id=2, anchor=('mid','mid'))
             y += 30
             counter += 1
@@ -193,6 +340,56 @@ class DexLister(Menu):
             self.last_played_wav = self.cursor
         
 
+class DexSearch(Menu):
+    def __init__(self, dex, display, audio, camera):
+        super().__init__(dex, display, audio, camera)
+        self.entry_lister = DexEntryLister(dex, display, audio, camera, auto_cry=True)
+        self.letters = 'abcdefghijklmnopqrstuvwxyz0123456789 -.'
+        self.letter = 0
+        self.query = ''
+        self.results = []
+        self.max_results = 7
+        
+    def enter(self):
+        self.audio.stop()
+        self.search()
+        
+    def search(self):
+        self.results = self.dex.search(self.query + self.letters[self.letter], self.max_results)
+        
+    def update(self, delta_time, actions):
+        if A.MENU_OK in actions:
+            if self.results:
+                self.dex.set_current_entry(self.results[0])
+                return self.swap_menu(self.entry_lister)
+        elif A.MENU_LEFT in actions:
+            if not self.query:
+                return self.previous_menu
+            self.query = self.query[:-1]
+            self.search()
+        elif A.MENU_RIGHT in actions:
+            self.query += self.letters[self.letter]
+            self.search()
+        elif A.MENU_UP in actions:
+            self.letter = (self.letter-1) % len(self.letters)
+            self.search()
+        elif A.MENU_DOWN in actions:
+            self.letter = (self.letter+1) % len(self.letters)
+            self.search()
+            
+    def render(self):
+        self.display.draw_text("Search", (10,10), (50,100,50))
+        self.display.draw_text(self.query, (30,60), (10,10,10))
+        x = 30 + self.display.get_text_size(self.query)[0]
+        self.display.draw_text(self.letters[self.letter].replace(' ', '_'), (x,60), (250,10,100))
+        x,y = 60,120
+        for index in self.results:
+            color = (250,10,100) if index == self.results[0] else (10,10,10)
+            self.display.draw_text(self.dex.get_names(index, index+1)[0], (x,y), color, font_id=1, anchor=('left','mid'))
+            self.display.draw_text(str(index+1), (x-25,y), color, font_id=2, anchor=('mid','mid'))
+            y += 28
+            
+            
 class DexEntryLister(Menu):
     def __init__(self, dex, display, audio, camera, auto_speech=False, auto_cry=False):
         super().__init__(dex, display, audio, camera)
@@ -209,6 +406,18 @@ class DexEntryLister(Menu):
         self.auto_cry_done = False
         self.auto_speech_done = False
         self.pkmn_img = self.display.load_image(self.data['image'])
+        self.display.prefetch_images([self.dex.get_sprite_of(i) 
+                                      for i in neighbour_indices(self.dex.current_index, len(self.dex))])
+        #synthesize the description of this entry first, then the ones up/down would go to
+        self.audio.prefetch_speech([self.data['description']] + 
+                                   [self.dex.get_data_of(i)['description'] 
+                                    for i in neighbour_indices(self.dex.current_index, len(self.dex), (1,-1))])
+        
+    def get_refresh_rate(self):
+        #keep polling while the auto speech waits for the cry to finish
+        if self.auto_speech and not self.auto_speech_done:
+            return 10
+        return self.refresh_rate
     
     def update(self, delta_time, actions):
         if A.MENU_OK in actions:
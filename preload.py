@@ -0,0 +1,101 @@
+import os
+from concurrent.futures import as_completed
+from multiprocessing import shared_memory, resource_tracker
+
+from workers import make_process_pool
+from display import PACKED_FORMATS, image_bytes, image_to_bytes, image_from_bytes
+
+try:
+    import pygame
+except ImportError: pass
+
+
+#worker side: decode into a new shared memory block and return its name, the block outlives the worker
+
+def _init_worker(mixer_format):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    if mixer_format is not None:
+        frequency, size, channels = mixer_format
+        pygame.mixer.init(frequency=frequency, size=size, channels=channels)
+
+def _share(nbytes):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+    return shm
+
+def _decode_image(filepath, size, pixel_format, missing_file):
+    if not os.path.isfile(filepath):
+        filepath = missing_file
+    img = pygame.transform.scale(pygame.image.load(filepath), size)
+    shm = _share(image_bytes(size, pixel_format))
+    if pixel_format in PACKED_FORMATS:
+        data = image_to_bytes(img, pixel_format)
+        shm.buf[:len(data)] = data
+    else:
+        #scale straight into a surface backed by the shared block
+        target = pygame.image.frombuffer(shm.buf, size, pixel_format)
+        target.blit(img, (0,0))
+        del target
+    name = shm.name
+    shm.close()
+    return name
+
+def _decode_sound(filepath):
+    raw = pygame.mixer.Sound(filepath).get_raw()
+    shm = _share(len(raw))
+    shm.buf[:len(raw)] = raw
+    name = shm.name
+    shm.close()
+    return name, len(raw)
+
+
+def _attach(name):
+    #unlink right away: the mapping stays valid and nothing is left in /dev/shm on exit
+    shm = shared_memory.SharedMemory(name=name)
+    shm.unlink()
+    return shm
+
+
+class ParallelPreloader(object):
+    def __init__(self, workers=None, mixer_format=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.mixer_format = mixer_format
+        #shared blocks that back preloaded surfaces, they have to live as long as the surfaces
+        self.blocks = []
+
+    def _run(self, func, files, args, progress):
+        #workers have to share our resource tracker, or it would unlink their blocks when they exit
+        resource_tracker.ensure_running()
+        with make_process_pool(self.workers, _init_worker, (self.mixer_format,)) as pool:
+            futures = {pool.submit(func, filepath, *args): filepath for filepath in files}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print('Could not preload %s: %s' % (futures[future], e))
+                    result = None
+                if progress is not None:
+                    progress(done, len(futures))
+                if result is not None:
+                    yield futures[future], result
+
+    def load_images(self, files, size=(180,180), pixel_format='RGBX', missing_file='unknown.png', progress=None):
+        images = {}
+        for filepath, name in self._run(_decode_image, files, (size, pixel_format, missing_file), progress):
+            shm = _attach(name)
+            images[filepath] = image_from_bytes(shm.buf, size, pixel_format)
+            if pixel_format in PACKED_FORMATS:
+                shm.close() #the surface has its own copy
+            else:
+                self.blocks.append(shm)
+        return images
+
+    def load_sounds(self, files, progress=None):
+        #pygame copies the buffer into its own chunk, so the block can be released afterwards
+        sounds = {}
+        files = [filepath for filepath in files if os.path.isfile(filepath)]
+        for filepath, (name, nbytes) in self._run(_decode_sound, files, (), progress):
+            shm = _attach(name)
+            sounds[filepath] = pygame.mixer.Sound(buffer=shm.buf[:nbytes])
+            shm.close()
+        return sounds
@@ -0,0 +1,297 @@
+import os, time, json, threading
+import cv2
+import numpy as np
+
+from workers import make_process_pool
+
+
+#feature vector: a zero mean thumbnail of the shape followed by a hue/saturation histogram of the colored pixels
+THUMB_SIZE = 16
+HIST_BINS = (12, 4)
+COLOR_WEIGHT = 0.7
+FEATURE_LENGTH = THUMB_SIZE*THUMB_SIZE + HIST_BINS[0]*HIST_BINS[1]
+
+
+def load_sprite(filepath, background=(255,255,255)):
+    #sprites are transparent pngs, the camera sees them on a plain background
+    img = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return None
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 4:
+        alpha = img[:,:,3:].astype(np.float32) / 255.
+        img = (img[:,:,:3] * alpha + np.array(background, np.float32) * (1.-alpha)).astype(np.uint8)
+    return img
+
+def center_square(img, roi=None):
+    #roi is (x, y, w, h) in frame pixels, otherwise the largest centered square is used
+    if roi is not None:
+        x,y,w,h = roi
+        img = img[y:y+h, x:x+w]
+    h,w = img.shape[:2]
+    side = min(h,w)
+    top, left = (h-side)//2, (w-side)//2
+    return img[top:top+side, left:left+side]
+
+def crop_to_content(img, threshold=40):
+    #square around everything that differs from the border color, so the distance to the camera does not matter
+    border = np.concatenate([img[0], img[-1], img[:,0], img[:,-1]])
+    background = np.median(border, axis=0)
+    mask = (np.abs(img.astype(np.int16) - background.astype(np.int16)).max(axis=2) > threshold).astype(np.uint8)
+    points = cv2.findNonZero(mask)
+    if points is None:
+        return img
+    x,y,w,h = cv2.boundingRect(points)
+    side = max(w,h)
+    top = min(max(0, y + h//2 - side//2), max(0, img.shape[0]-side))
+    left = min(max(0, x + w//2 - side//2), max(0, img.shape[1]-side))
+    return img[top:top+side, left:left+side]
+
+def features_of(img):
+    #img is a BGR image, row-major (h,w,3)
+    #shrink before looking for the sprite, full camera frames are far larger than needed
+    img = cv2.resize(center_square(img), (THUMB_SIZE*8, THUMB_SIZE*8), interpolation=cv2.INTER_AREA)
+    img = cv2.resize(crop_to_content(img), (THUMB_SIZE*4, THUMB_SIZE*4), interpolation=cv2.INTER_AREA)
+    gray = cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (THUMB_SIZE, THUMB_SIZE),
+                      interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+    gray -= gray.mean()
+    norm = np.linalg.norm(gray)
+    if norm > 0:
+        gray /= norm
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    #ignore the background and dark outlines, they look alike for every sprite
+    mask = cv2.inRange(hsv, (0, 50, 40), (180, 255, 255))
+    hist = cv2.calcHist([hsv], [0,1], mask, list(HIST_BINS), [0,180,50,256]).ravel()
+    hist = np.sqrt(hist)
+    norm = np.linalg.norm(hist)
+    if norm > 0:
+        hist /= norm
+    feature = np.concatenate([gray * (1.-COLOR_WEIGHT), hist * COLOR_WEIGHT])
+    norm = np.linalg.norm(feature)
+    if norm > 0:
+        feature /= norm
+    return feature.astype(np.float32)
+
+
+def sprites_stamp(files):
+    #what a feature file was built from: the sprite list and the newest modification of any sprite
+    newest = 0
+    for filepath in files:
+        try:
+            newest = max(newest, os.stat(filepath).st_mtime_ns)
+        except OSError:
+            pass
+    return {'files': list(files), 'mtime_ns': newest, 'length': FEATURE_LENGTH}
+
+def build_features(files, feature_file=None, progress=None):
+    #one row per dex entry in file order, missing sprites get a zero row that never matches
+    matrix = np.zeros((len(files), FEATURE_LENGTH), np.float32)
+    for i, filepath in enumerate(files):
+        img = load_sprite(filepath) if os.path.isfile(filepath) else None
+        if img is not None:
+            matrix[i] = features_of(img)
+        if progress is not None:
+            progress(i+1, len(files))
+    if feature_file is not None:
+        #the stamp is written last, a matrix without a matching stamp is rebuilt
+        tmp_file = feature_file + '.tmp.npy'
+        np.save(tmp_file, matrix)
+        os.replace(tmp_file, feature_file)
+        with open(feature_file + '.json.tmp', 'w') as f:
+            json.dump(sprites_stamp(files), f)
+        os.replace(feature_file + '.json.tmp', feature_file + '.json')
+    return matrix
+
+
+class SpriteMatcher(object):
+    def __init__(self, matrix):
+        self.matrix = np.ascontiguousarray(matrix, np.float32)
+
+    @classmethod
+    def load(cls, feature_file):
+        return cls(np.load(feature_file))
+
+    @classmethod
+    def for_files(cls, files, feature_file='sprite_features.npy'):
+        #reuses the feature file unless the sprites were changed, added or removed since it was built
+        files = list(files)
+        try:
+            with open(feature_file + '.json') as f:
+                stamp = json.load(f)
+            if stamp == sprites_stamp(files):
+                matrix = np.load(feature_file)
+                if matrix.shape == (len(files), FEATURE_LENGTH):
+                    return cls(matrix)
+        except (OSError, ValueError):
+            pass
+        return cls(build_features(files, feature_file))
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def match(self, frame, k=5, roi=None):
+        #cosine similarity against every entry at once, returns [(index, score)] best first
+        if roi is not None:
+            frame = center_square(frame, roi)
+        scores = self.matrix @ features_of(frame)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k-1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
+
+
+class StabilityGate(object):
+    #decides from tiny grayscale thumbnails when a frame is worth a scan:
+    #the picture held still for stable_frames frames and it is not the scene that was scanned last
+    def __init__(self, stable_frames=5, motion_threshold=4., change_threshold=12., size=(32,24), roi=None):
+        self.stable_frames = stable_frames
+        self.motion_threshold = motion_threshold
+        self.change_threshold = change_threshold
+        self.size = size
+        self.roi = roi
+        self.reset()
+
+    def reset(self):
+        self.stable_count = 0
+        self._last = None
+        self._scanned = None
+
+    def crop(self, frame):
+        if self.roi is None:
+            return frame
+        x,y,w,h = self.roi
+        return frame[y:y+h, x:x+w]
+
+    def thumbnail(self, frame):
+        small = cv2.resize(self.crop(frame), self.size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.int16)
+
+    def update(self, frame):
+        thumb = self.thumbnail(frame)
+        if self._last is not None and np.abs(thumb - self._last).mean() < self.motion_threshold:
+            self.stable_count += 1
+        else:
+            self.stable_count = 0
+        self._last = thumb
+        if self.stable_count < self.stable_frames:
+            return False
+        if self._scanned is not None and np.abs(thumb - self._scanned).mean() < self.change_threshold:
+            return False
+        self._scanned = thumb
+        return True
+
+
+#worker side of ScanPool, every worker process loads the matcher once
+
+_worker_matcher = None
+
+def _init_scan_worker(files, feature_file):
+    global _worker_matcher
+    _worker_matcher = SpriteMatcher.for_files(files, feature_file)
+
+def _scan(frame, k, roi):
+    return _worker_matcher.match(frame, k, roi)
+
+
+class ScanPool(object):
+    #runs matches in worker processes, only the newest request is kept
+    def __init__(self, files, feature_file='sprite_features.npy', workers=1):
+        self.pool = make_process_pool(workers, _init_scan_worker, (list(files), feature_file))
+        self.job = None
+
+    def submit(self, frame, k=1, roi=None):
+        #the frame is copied right away, the camera may reuse its buffer before the job is sent
+        self.cancel()
+        self.job = self.pool.submit(_scan, np.array(frame), k, roi)
+        return self.job
+
+    def cancel(self):
+        #a job that already runs can not be stopped, its result is just dropped
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+
+    def close(self):
+        self.cancel()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+#one pool for every scanner menu, its worker holds cv2 and the feature matrix and is let go when idle
+
+_shared_pool = None
+_shared_timer = None
+_shared_lock = threading.Lock()
+
+def get_scan_pool(files, feature_file='sprite_features.npy'):
+    global _shared_pool, _shared_timer
+    with _shared_lock:
+        if _shared_timer is not None:
+            _shared_timer.cancel()
+            _shared_timer = None
+        if _shared_pool is None:
+            _shared_pool = ScanPool(files, feature_file)
+        return _shared_pool
+
+def release_scan_pool(idle_timeout=60.):
+    #shuts the pool down unless get_scan_pool is called again within idle_timeout seconds
+    global _shared_timer
+    with _shared_lock:
+        if _shared_pool is None or _shared_timer is not None:
+            return
+        _shared_timer = threading.Timer(idle_timeout, close_scan_pool)
+        _shared_timer.daemon = True
+        _shared_timer.start()
+
+def close_scan_pool():
+    global _shared_pool, _shared_timer
+    with _shared_lock:
+        if _shared_timer is not None:
+            _shared_timer.cancel()
+            _shared_timer = None
+        if _shared_pool is not None:
+            _shared_pool.close()
+            _shared_pool = None
+
+
+def augment(img, rng, frame_size=(320,240)):
+    #a sprite as a camera might see it: scaled, rotated, shifted, on a tinted background, with noise and blur
+    w,h = frame_size
+    side = int(min(w,h) * rng.uniform(.6, 1.))
+    angle = rng.uniform(-12, 12)
+    center = (w/2. + rng.uniform(-.08, .08)*w, h/2. + rng.uniform(-.08, .08)*h)
+    scale = side / float(img.shape[0])
+    m = cv2.getRotationMatrix2D((img.shape[1]/2., img.shape[0]/2.), angle, scale)
+    m[:,2] += (center[0] - img.shape[1]/2., center[1] - img.shape[0]/2.)
+    background = tuple(int(c) for c in rng.integers(190, 256, 3))
+    frame = cv2.warpAffine(img, m, (w,h), borderMode=cv2.BORDER_CONSTANT, borderValue=background)
+    frame = frame.astype(np.float32) * rng.uniform(.7, 1.2) + rng.uniform(-25, 25)
+    frame += rng.normal(0, 6, frame.shape)
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+    if rng.random() < .5:
+        frame = cv2.GaussianBlur(frame, (5,5), 0)
+    return frame
+
+
+def benchmark(files, matcher, samples=500, k=5, seed=0):
+    #accuracy and latency of matcher.match on augmented sprites of the indexed entries
+    rng = np.random.default_rng(seed)
+    indices = [i for i, filepath in enumerate(files) if os.path.isfile(filepath)]
+    if not indices:
+        raise ValueError('No sprites to benchmark')
+    top1 = topk = 0
+    times = []
+    for n in range(samples):
+        index = indices[rng.integers(len(indices))]
+        frame = augment(load_sprite(files[index]), rng)
+        start = time.perf_counter()
+        result = matcher.match(frame, k)
+        times.append(time.perf_counter() - start)
+        ranked = [i for i, score in result]
+        top1 += ranked[0] == index
+        topk += index in ranked
+    times = np.array(times) * 1000.
+    return {
+        'samples': samples, 'top1': top1 / float(samples), 'top%d' % k: topk / float(samples),
+        'mean_ms': float(times.mean()), 'p95_ms': float(np.percentile(times, 95)),
+    }
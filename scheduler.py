@@ -0,0 +1,31 @@
+import time
+
+
+class FrameScheduler(object):
+    def __init__(self, max_fps=30., idle_timeout=1.):
+        self.min_interval = 1./max_fps
+        self.idle_timeout = idle_timeout
+        self.last_render = 0.
+        self.pending = False
+        
+    def get_timeout(self, menu):
+        #menus that do not animate are only redrawn on input, or after idle_timeout
+        rate = menu.get_refresh_rate()
+        interval = max(1./rate, self.min_interval) if rate else self.idle_timeout
+        if self.pending:
+            interval = self.min_interval
+        return max(0., self.last_render + interval - time.time())
+        
+    def wait(self, controller, menu):
+        return controller.wait_actions(self.get_timeout(menu))
+        
+    def should_render(self):
+        #frames closer together than max_fps are deferred to the next wake up
+        if time.time() - self.last_render < self.min_interval:
+            self.pending = True
+            return False
+        return True
+        
+    def rendered(self):
+        self.last_render = time.time()
+        self.pending = False
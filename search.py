@@ -0,0 +1,110 @@
+import unicodedata, bisect
+from array import array
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(text.casefold().split())
+
+
+def trigrams(text):
+    return {text[i:i+3] for i in range(len(text)-2)}
+
+
+class DexSearchIndex(object):
+    #ranks: exact name, name prefix, prefix of a word in the name, name substring, description
+    EXACT, PREFIX, WORD_PREFIX, NAME, DESCRIPTION = range(5)
+
+    def __init__(self, names, descriptions=None):
+        self.names = [normalize(name) for name in names]
+        self.descriptions = [normalize(d) for d in descriptions] if descriptions is not None else None
+        #sorted (word, index) pairs for prefix queries on names and every word in them
+        words = set()
+        for index, name in enumerate(self.names):
+            words.add((name, index))
+            for word in name.replace('-', ' ').replace('.', ' ').split():
+                words.add((word, index))
+        self.words = sorted(words)
+        self.word_keys = [word for word,index in self.words]
+        #trigram posting lists for substring queries
+        self.trigrams = {}
+        texts = [self.names] if self.descriptions is None else [self.names, self.descriptions]
+        for column in texts:
+            for index, text in enumerate(column):
+                for gram in trigrams(text):
+                    postings = self.trigrams.setdefault(gram, array('I'))
+                    if not postings or postings[-1] != index:
+                        postings.append(index)
+        self._last_query = None
+        self._last_matches = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _prefix_matches(self, query):
+        matches = set()
+        i = bisect.bisect_left(self.word_keys, query)
+        while i < len(self.words) and self.word_keys[i].startswith(query):
+            matches.add(self.words[i][1])
+            i += 1
+        return matches
+
+    def _candidates(self, query):
+        #when the query extends the previous one only its matches have to be checked again,
+        #_last_query is only kept for queries of 3+ characters, shorter ones only collect word prefixes
+        if self._last_query and query.startswith(self._last_query):
+            return self._last_matches
+        if len(query) < 3:
+            return self._prefix_matches(query)
+        grams = sorted(trigrams(query), key=lambda g: len(self.trigrams.get(g, ())))
+        candidates = set(self.trigrams.get(grams[0], ()))
+        for gram in grams[1:]:
+            if not candidates: break
+            candidates.intersection_update(self.trigrams.get(gram, ()))
+        return candidates | self._prefix_matches(query)
+
+    def rank(self, query, index):
+        name = self.names[index]
+        if name == query: return self.EXACT
+        if name.startswith(query): return self.PREFIX
+        if (' '+name).replace('-', ' ').replace('.', ' ').find(' '+query) >= 0: return self.WORD_PREFIX
+        if query in name: return self.NAME
+        if self.descriptions is not None and query in self.descriptions[index]: return self.DESCRIPTION
+        return None
+
+    def search(self, query, limit=10):
+        query = normalize(query)
+        if not query:
+            self._last_query = None
+            return []
+        scored = []
+        matches = set()
+        for index in self._candidates(query):
+            rank = self.rank(query, index)
+            if rank is not None:
+                scored.append((rank, index))
+                matches.add(index)
+        if len(query) >= 3:
+            self._last_query = query
+            self._last_matches = matches
+        else:
+            self._last_query = None
+            self._last_matches = None
+        scored.sort()
+        return [index for rank,index in scored[:limit]]
+
+
+def check_incremental(index, texts, limit=10):
+    #typing every prefix of every text has to give the same results as a fresh search for it
+    mismatches = []
+    for text in texts:
+        text = normalize(text)
+        for end in range(1, len(text)+1):
+            typed = index.search(text[:end], limit)
+            index._last_query = None
+            fresh = index.search(text[:end], limit)
+            if typed != fresh:
+                mismatches.append(text[:end])
+        index._last_query = None
+    return mismatches
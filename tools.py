@@ -0,0 +1,157 @@
+import argparse
+
+
+def compile_dex(args):
+    from dex import compile_db
+    compile_db(args.src, args.dst)
+    print('Compiled %s into %s' % (args.src, args.dst))
+    args.db = args.dst
+    explain_dex(args)
+    
+def explain_dex(args):
+    from dex import DexDatabase
+    db = DexDatabase(args.db)
+    for step in db.explain_info():
+        print('  ' + step)
+    scans = db.check_query_plan()
+    db.close()
+    if scans:
+        raise SystemExit('Main dex query scans without an index: %s' % ', '.join(scans))
+    print('Main dex query uses indexes only')
+    
+
+def build_atlas(args):
+    import os
+    import pygame
+    from dex import VeekunPokedex
+    from display import SpriteAtlas, get_pixel_format
+    #match the pixel format of the screen the atlas will be shown on
+    if os.uname()[4][:3] == 'arm':
+        os.putenv('SDL_VIDEODRIVER', 'fbcon')
+        os.putenv('SDL_FBDEV', '/dev/fb1')
+    pixel_format = args.format
+    if pixel_format is None:
+        try:
+            pygame.display.init()
+            screen = pygame.display.set_mode((1,1))
+            pixel_format = get_pixel_format(screen, exact=True)
+            if pixel_format is None:
+                print('Warning: no atlas format matches the %d bit screen (masks %s), sprites are converted on every blit' % (
+                    screen.get_bitsize(), ', '.join('%#x' % m for m in screen.get_masks()[:3])))
+            pygame.display.quit()
+        except pygame.error as e:
+            print('Warning: could not open the screen to match its pixel format (%s)' % e)
+        if pixel_format is None:
+            pixel_format = get_pixel_format(None)
+    files = VeekunPokedex().get_image_files()
+    count = SpriteAtlas.build(files, args.dst, (args.size, args.size), pixel_format)
+    print('Packed %d sprites for %d entries into %s (%s)' % (count, len(files), args.dst, pixel_format))
+    
+def build_features(args):
+    from dex import VeekunPokedex
+    from recognition import build_features
+    files = VeekunPokedex().get_image_files()
+    matrix = build_features(files, args.dst)
+    print('Indexed %d sprites into %s (%d values each)' % (matrix.shape[0], args.dst, matrix.shape[1]))
+    
+def benchmark_scan(args):
+    from dex import VeekunPokedex
+    from recognition import SpriteMatcher, benchmark
+    files = VeekunPokedex().get_image_files()
+    matcher = SpriteMatcher.for_files(files, args.features)
+    result = benchmark(files, matcher, args.samples, args.k, args.seed)
+    print('%d augmented sprites: top-1 %.1f%%, top-%d %.1f%%, %.2f ms mean, %.2f ms p95' % (
+        result['samples'], result['top1']*100, args.k, result['top%d' % args.k]*100, result['mean_ms'], result['p95_ms']))
+    
+def prerender_speech(args):
+    import time
+    from dex import VeekunPokedex
+    from audio import GTTSSynthesizer, PyTTSx3Synthesizer, speech_cache, prerender
+    dex = VeekunPokedex(version=args.version, language=args.language)
+    texts = [dex.get_data_of(i)['description'] for i in range(len(dex))]
+    if args.engine == 'pyttsx3':
+        synthesizer = PyTTSx3Synthesizer(args.voice, args.lang)
+    else:
+        synthesizer = GTTSSynthesizer(args.lang)
+    cache = speech_cache(synthesizer, args.cache_dir, args.max_mb*1024*1024 if args.max_mb else None)
+    start = time.time()
+    def progress(done, total):
+        if done % 25 == 0 or done == total:
+            elapsed = time.time() - start
+            print('  %d/%d, %.2f texts/s' % (done, total, done / elapsed if elapsed > 0 else 0.))
+    try:
+        result = prerender(texts, synthesizer, cache, args.workers, progress)
+    except ValueError as e:
+        raise SystemExit('%s, run again with a larger --max-mb' % e)
+    elapsed = time.time() - start
+    print('%d texts: %d already cached, %d rendered, %d failed, %d evicted in %.1fs (%.2f texts/s)' % (
+        result['texts'], result['cached'], result['rendered'], result['failed'], result['evicted'], elapsed, 
+        result['rendered'] / elapsed if elapsed > 0 else 0.))
+    stats = cache.stats()
+    print('Cache %s holds %d files, %.1f of %.1f MB' % (cache.directory, stats['entries'], 
+                                                       stats['size']/2.**20, stats['max_size']/2.**20))
+    
+def check_search(args):
+    from dex import VeekunPokedex
+    from search import check_incremental
+    dex = VeekunPokedex()
+    data = [dex.get_data_of(i) for i in range(len(dex))]
+    texts = [d['name'] for d in data] + [word for d in data[:args.descriptions] for word in d['description'].split()]
+    mismatches = check_incremental(dex.get_search_index(), texts)
+    if mismatches:
+        raise SystemExit('Incremental search differs from a fresh search for: %s' % ', '.join(mismatches[:20]))
+    print('Incremental search matches fresh search for %d texts' % len(texts))
+    
+def main():
+    parser = argparse.ArgumentParser(description='PokeDex build tools')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    
+    cmd = commands.add_parser('compile', help='build the slim read-only dex database')
+    cmd.add_argument('--src', default='pokedex.sqlite')
+    cmd.add_argument('--dst', default='pokedex.min.sqlite')
+    cmd.set_defaults(func=compile_dex)
+    
+    cmd = commands.add_parser('explain', help='check that the main dex query only uses indexes')
+    cmd.add_argument('--db', default='pokedex.min.sqlite')
+    cmd.set_defaults(func=explain_dex)
+    
+    cmd = commands.add_parser('search', help='check that search while typing matches a fresh search')
+    cmd.add_argument('--descriptions', type=int, default=50, help='also type the words of this many descriptions')
+    cmd.set_defaults(func=check_search)
+    
+    cmd = commands.add_parser('atlas', help='pack all sprites, scaled and converted, into one mmap atlas')
+    cmd.add_argument('--dst', default='sprites.atlas')
+    cmd.add_argument('--size', type=int, default=180)
+    cmd.add_argument('--format', choices=['RGBX', 'BGRA', 'RGB565', 'RGB555'], default=None)
+    cmd.set_defaults(func=build_atlas)
+    
+    cmd = commands.add_parser('features', help='compute the sprite feature matrix used by the scanner')
+    cmd.add_argument('--dst', default='sprite_features.npy')
+    cmd.set_defaults(func=build_features)
+    
+    cmd = commands.add_parser('benchmark', help='measure scanner accuracy and latency on augmented sprites')
+    cmd.add_argument('--features', default='sprite_features.npy')
+    cmd.add_argument('--samples', type=int, default=500)
+    cmd.add_argument('-k', type=int, default=5)
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.set_defaults(func=benchmark_scan)
+    
+    cmd = commands.add_parser('speech', help='synthesize all descriptions of a version and language into the tts cache')
+    cmd.add_argument('--version', default='Black')
+    cmd.add_argument('--language', default='English')
+    cmd.add_argument('--engine', choices=['gtts', 'pyttsx3'], default='gtts')
+    cmd.add_argument('--lang', default='en', help='language code passed to the speech engine')
+    cmd.add_argument('--voice', default=None, help='pyttsx3 voice id')
+    cmd.add_argument('--workers', type=int, default=4)
+    cmd.add_argument('--cache-dir', default='tts_cache')
+    cmd.add_argument('--max-mb', type=int, default=None, 
+                     help='byte budget of the speech cache, kept for the device (default: the current one, 64 MB when new)')
+    cmd.set_defaults(func=prerender_speech)
+    
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def make_process_pool(workers, initializer=None, initargs=()):
+    #workers come from a forkserver: by the time a pool is made the app runs camera, loader, audio and
+    #prefetch threads, and forking a process in that state can deadlock the child
+    return ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs,
+                               mp_context=multiprocessing.get_context('forkserver'))